@@ -1,8 +1,25 @@
+import asyncio
+import fcntl
+import functools
 import os
+import gzip
+import queue
+import re
+import bisect
+import hashlib
+import hmac
+import json
+import shutil
+import tempfile
 import threading
-from datetime import datetime, timedelta, timezone
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from datetime import date, datetime, timedelta, timezone
 import sqlite3
-from flask import Flask, request, jsonify
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
 from telegram import Update, Bot
 from telegram.ext import (
@@ -11,13 +28,45 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
+from a2wsgi import WSGIMiddleware
+import uvicorn
 import pytz
 
+# необязательные ускорители ответов: без них работают json и gzip из стандартной библиотеки
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 load_dotenv()
 
 SQLITE_DB = os.getenv("SQLITE_DB", "your_bot_db.sqlite")
 USERS_TABLE = 'users'
 INVITES_TABLE = 'invites'
+BARS_TABLE = 'bars'
+INVENTORY_TABLE = 'inventory'
+APP_STATE_TABLE = 'app_state'
+CHANGE_LOG_TABLE = 'change_log'
+EXPIRY_DIGEST_TABLE = 'expiry_digest'
+BAR_VERSIONS_TABLE = 'bar_versions'
+INVENTORY_STATS_TABLE = 'inventory_stats'
+CATALOG_TABLE = 'catalog'
+ARCHIVE_TABLE = 'inventory_archive'
+JOURNAL_TABLES = (USERS_TABLE, INVITES_TABLE, BARS_TABLE, INVENTORY_TABLE, CATALOG_TABLE, ARCHIVE_TABLE)
+# PRAGMA user_version, которым ensure_base_schema помечала базу до появления
+# schema_version. Заморожено: базовая схема теперь шаг 0 в schema_version,
+# а все новые изменения — только шагами SCHEMA_MIGRATIONS
+BASE_SCHEMA_USER_VERSION = 7
+SCHEMA_VERSION_TABLE = 'schema_version'  # применённые шаги: 0 — базовая схема, дальше SCHEMA_MIGRATIONS
+# начальный список баров; новые добавляются в реестр командой /addbar
 BARS = ['АВОШ59', 'АВПМ97', 'АВЯР01', 'АВКОСМ04', 'АВКО04', 'АВДШ02', 'АВКШ78', 'АВПМ58', 'АВЛБ96']
 CATEGORIES = ["🍯 Сиропы", "🥕 Ингредиенты", "☕ Кофе", "📦 Прочее"]
 REG_WAIT_CODE = 0
@@ -38,56 +87,1072 @@ CORS(
 
 MSK_TZ = timezone(timedelta(hours=3))
 
+PROCESS_STARTED_AT = time.monotonic()
+_first_request_seen = False
+
+@app.before_request
+def log_time_to_first_request():
+    global _first_request_seen
+    if not _first_request_seen:
+        _first_request_seen = True
+        print(f"[startup] Первый запрос через {time.monotonic() - PROCESS_STARTED_AT:.2f} с после старта процесса")
+
 TELEGRAM_ADMIN_ID = 1209688883  # твой user_id
 DB_FILENAME = SQLITE_DB
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-last_backup_time = None  # глобальная переменная для хранения времени последнего бэкапа
+# пул потоков для запросов к API и работы с базой из event loop
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", 16))
+db_executor = ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="db")
+# отдельный пул для обработчиков бота: бэкап или тяжёлая команда не занимает потоки API
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 4))
+bot_executor = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix="bot")
+# event loop и Bot работающего приложения — для отправки файлов из потоков планировщика;
+# backup_task — бэкап, запущенный из чата (одновременно выполняется только один)
+bot_runtime = SimpleNamespace(loop=None, bot=None, backup_task=None, scheduler=None)
 
-def ensure_bar_table(bar_name):
-    if bar_name not in BARS:
-        raise Exception("Неизвестный бар")
-    with sqlite3.connect(SQLITE_DB) as conn:
-        cursor = conn.cursor()
+# --- Метрики (формат Prometheus, /metrics) ---
+# Счётчики живут в памяти процесса: под gunicorn у каждого воркера свои,
+# метка worker позволяет суммировать их на стороне Prometheus.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# служебные эндпоинты требуют Authorization: Bearer <токен>; без токена в окружении они закрыты
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # /metrics
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # /stats с all=true
+
+def has_bearer_token(token):
+    """Заголовок Authorization несёт этот токен; незаданный токен не пускает никого."""
+    if not token:
+        return False
+    # байты, а не str: compare_digest падает на не-ASCII строках, а заголовок присылает клиент
+    return hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()
+    )
+
+_metrics_lock = threading.Lock()
+_counters = {}    # (имя, метки) -> значение
+_gauges = {}      # (имя, метки) -> значение
+_histograms = {}  # (имя, метки) -> [счётчики по корзинам..., сумма, количество]
+_metric_help = {
+    'http_request_duration_seconds': ('histogram', "Время обработки HTTP-запроса"),
+    'http_request_db_queries': ('histogram', "Запросов к базе на один HTTP-запрос"),
+    'http_request_db_seconds': ('histogram', "Время в базе на один HTTP-запрос"),
+    'db_query_duration_seconds': ('histogram', "Время выполнения SQL по шаблону запроса"),
+    'db_connections_opened_total': ('counter', "Открыто соединений SQLite"),
+    'backup_duration_seconds': ('histogram', "Время снятия и отправки бэкапа"),
+    'write_queue_batch_size': ('histogram', "Операций записи в одном групповом коммите"),
+    'backups_total': ('counter', "Бэкапы по результату"),
+    'backup_last_size_bytes': ('gauge', "Размер последнего снимка"),
+    'backup_last_success_timestamp_seconds': ('gauge', "Время последнего отправленного бэкапа"),
+}
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def metric_inc(name, labels=None, value=1):
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def metric_set(name, value, labels=None):
+    with _metrics_lock:
+        _gauges[(name, _labels(labels))] = value
+
+def metric_observe(name, value, labels=None, buckets=LATENCY_BUCKETS):
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(buckets) + 2) + [buckets]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-3] += value
+        hist[-2] += 1
+
+def histogram_quantile(hist, q):
+    """Верхняя граница корзины, в которую попадает квантиль q (как histogram_quantile без интерполяции)."""
+    buckets = hist[-1]
+    rank = q * hist[-2]
+    total = 0
+    for i, bound in enumerate(buckets):
+        total += hist[i]
+        if total >= rank:
+            return bound
+    return float('inf')
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def render_metrics():
+    worker = (('worker', os.getpid()),)
+    with _metrics_lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: list(hist) for key, hist in _histograms.items()}
+    lines = []
+    described = set()
+    def describe(name):
+        if name not in described:
+            described.add(name)
+            kind, text = _metric_help.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+    for (name, labels), value in sorted(counters.items()) + sorted(gauges.items()):
+        describe(name)
+        lines.append(f"{name}{_format_labels(labels + worker)} {value}")
+    for (name, labels), hist in sorted(histograms.items()):
+        describe(name)
+        cumulative = 0
+        for bound, count in zip(hist[-1], hist):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels + worker, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels + worker, [('le', '+Inf')])} {hist[-2]}")
+        lines.append(f"{name}_sum{_format_labels(labels + worker)} {hist[-3]}")
+        lines.append(f"{name}_count{_format_labels(labels + worker)} {hist[-2]}")
+    return "\n".join(lines) + "\n"
+
+SQL_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+
+@functools.lru_cache(maxsize=1024)
+def sql_template(sql):
+    """Метка запроса: SQL без лишних пробелов, списки IN (?, ?, ...) схлопнуты в один шаблон."""
+    return SQL_PLACEHOLDER_LIST.sub("?, ...", " ".join(sql.split()))[:200]
+
+def record_db_query(sql, seconds):
+    metric_observe('db_query_duration_seconds', seconds, {'query': sql_template(sql)})
+    _db_local.request_queries = getattr(_db_local, 'request_queries', 0) + 1
+    _db_local.request_db_seconds = getattr(_db_local, 'request_db_seconds', 0.0) + seconds
+
+# шаблон -> (sql, params) первого выполнения; включается capture_query_samples() для аудита планов
+_query_samples = None
+
+def capture_query_samples():
+    global _query_samples
+    _query_samples = {}
+
+PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+def explain_query_samples():
+    """EXPLAIN QUERY PLAN для каждого пойманного шаблона.
+
+    Возвращает [(шаблон, строки плана, полные проходы)]; полный проход — SCAN
+    по обычной таблице (в том числе по всему индексу), FTS и подзапросы не в счёт.
+    """
+    conn = get_db()
+    tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    report = []
+    for template, (sql, params) in sorted(list(_query_samples.items())):
+        if not sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+            continue
+        try:
+            plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error as e:
+            plan = [f"ошибка: {e}"]
+        scans = [
+            d for d in plan
+            if d.startswith('SCAN ') and d.split()[1] in tables and 'VIRTUAL TABLE' not in d
+        ]
+        report.append((template, plan, scans))
+    return report
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет запрос целиком: execute и чтение строк.
+
+    Запрос без строк результата (запись, DDL, BEGIN/COMMIT) записывается в
+    метрику сразу. Выборка — когда результат дочитан, прочитана одна строка
+    через fetchone, курсор закрыт или на нём выполнен следующий запрос.
+    Из финализатора не записываем: он может сработать при сборке мусора
+    в потоке, который уже держит _metrics_lock, и в чужом запросе.
+    """
+    _sql = None
+    _seconds = 0.0
+
+    def _record(self):
+        if self._sql is not None:
+            record_db_query(self._sql, self._seconds)
+            self._sql = None
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._seconds += time.perf_counter() - started
+
+    def execute(self, sql, params=()):
+        self._record()
+        if _query_samples is not None:
+            _query_samples.setdefault(sql_template(sql), (sql, params))
+        self._sql, self._seconds = sql, 0.0
+        try:
+            cursor = self._timed(super().execute, sql, params)
+        except BaseException:
+            self._record()
+            raise
+        if self.description is None:
+            self._record()
+        return cursor
+
+    def executemany(self, sql, seq_of_params):
+        self._record()
+        self._sql, self._seconds = sql, 0.0
+        try:
+            return self._timed(super().executemany, sql, seq_of_params)
+        finally:
+            self._record()
+
+    def fetchone(self):
+        # fetchone читает одну строку (поиск по ключу), дочитывать результат никто не будет
+        try:
+            return self._timed(super().fetchone)
+        finally:
+            self._record()
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        if not rows:
+            self._record()
+        return rows
+
+    def fetchall(self):
+        try:
+            return self._timed(super().fetchall)
+        finally:
+            self._record()
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._record()
+            raise
+
+    def close(self):
+        self._record()
+        super().close()
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Соединение, у которого и conn.execute идёт через InstrumentedCursor.
+
+    Встроенный Connection.execute создаёт обычный sqlite3.Cursor в обход
+    cursor(), поэтому прагмы, VACUUM и compact_db иначе не попадали в метрики.
+    """
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            record_db_query(script, time.perf_counter() - started)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    _db_local.request_queries = 0
+    _db_local.request_db_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        metric_observe('http_request_duration_seconds', time.perf_counter() - started, {
+            'endpoint': endpoint, 'method': request.method, 'status': response.status_code,
+        })
+        metric_observe('http_request_db_queries', _db_local.request_queries, {'endpoint': endpoint}, COUNT_BUCKETS)
+        metric_observe('http_request_db_seconds', _db_local.request_db_seconds, {'endpoint': endpoint})
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def api_metrics():
+    if not has_bearer_token(METRICS_TOKEN):
+        return Response("Нет доступа\n", status=403, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- Подключения к SQLite ---
+# Одно соединение на поток (Flask, планировщик бэкапов, бот), WAL позволяет
+# читать и писать одновременно без "database is locked".
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8000",       # ~8MB страничного кэша
+    "PRAGMA mmap_size=67108864",     # 64MB
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+)
+
+_db_local = threading.local()
+_db_lock = threading.Lock()
+_db_connections = set()
+_db_generation = 0
+
+def _open_db():
+    # файла может не быть при первом запуске — его создаст ensure_schema;
+    # наличие файла проверяют только бэкап и восстановление
+    conn = sqlite3.connect(
+        SQLITE_DB,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # транзакции открываем явно через db_transaction
+        check_same_thread=False,
+        factory=InstrumentedConnection,
+    )
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    conn.create_function("casefold", 1, lambda v: v.casefold() if isinstance(v, str) else v, deterministic=True)
+    with _db_lock:
+        _db_connections.add(conn)
+    metric_inc('db_connections_opened_total')
+    return conn
+
+# подмену файла другим воркером проверяем не чаще раза в DB_FILE_CHECK_SECONDS:
+# os.stat на каждый запрос заметен на горячем пути, а восстановление — редкость
+DB_FILE_CHECK_SECONDS = float(os.getenv("DB_FILE_CHECK_SECONDS", 1))
+
+def _db_file_id():
+    try:
+        st = os.stat(SQLITE_DB)
+    except FileNotFoundError:
+        return None
+    return st.st_dev, st.st_ino
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and not _db_local.depth:
+        if _db_local.generation != _db_generation:
+            _forget_db(conn)
+            conn = None
+        elif time.monotonic() - _db_local.file_checked_at >= DB_FILE_CHECK_SECONDS:
+            _db_local.file_checked_at = time.monotonic()
+            if _db_local.file_id != _db_file_id():
+                # файл базы подменил другой воркер (восстановление из бэкапа)
+                _forget_db(conn)
+                conn = None
+                invalidate_user_cache()
+                invalidate_schema_cache()
+    if conn is None:
+        conn = _open_db()
+        _db_local.conn = conn
+        _db_local.generation = _db_generation
+        _db_local.file_id = _db_file_id()
+        _db_local.file_checked_at = time.monotonic()
+        _db_local.depth = 0
+    return conn
+
+def _forget_db(conn):
+    with _db_lock:
+        _db_connections.discard(conn)
+    try:
+        conn.close()
+    except Exception:
+        pass
+    if getattr(_db_local, 'conn', None) is conn:
+        _db_local.conn = None
+
+def reset_db_connections():
+    """Закрывает все соединения, например перед заменой файла базы."""
+    global _db_generation
+    with _db_lock:
+        conns = list(_db_connections)
+        _db_connections.clear()
+        _db_generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _db_local.conn = None
+
+@contextmanager
+def db_transaction(immediate=False):
+    """Курсор внутри одной транзакции; вложенные вызовы присоединяются к внешней."""
+    conn = get_db()
+    cursor = conn.cursor()
+    if _db_local.depth:
+        _db_local.depth += 1
+        try:
+            yield cursor
+        finally:
+            _db_local.depth -= 1
+        return
+    cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _db_local.depth = 1
+    try:
+        yield cursor
+        cursor.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _db_local.depth = 0
+
+def replace_db_file(src_path):
+    """Атомарно подменяет файл базы, не оставляя WAL от старой базы."""
+    reset_db_connections()
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(SQLITE_DB + suffix):
+            os.remove(SQLITE_DB + suffix)
+    os.replace(src_path, SQLITE_DB)
+    invalidate_user_cache()
+    invalidate_response_cache()
+    invalidate_schema_cache()
+
+# --- Схема: реестр баров и общая таблица позиций ---
+_schema_lock = threading.Lock()
+_schema_ready = False
+_bar_ids = {}  # bar_name -> bar_id
+
+def invalidate_schema_cache():
+    global _schema_ready
+    with _schema_lock:
+        _schema_ready = False
+        _bar_ids.clear()
+
+def ensure_schema():
+    """Создаёт и мигрирует схему по шагам из schema_version (см. apply_schema_migrations)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        apply_schema_migrations()
+        _schema_ready = True
+
+def ensure_base_schema():
+    """Шаг 0: базовая схема — реестр баров, inventory с производными таблицами и триггерами.
+
+    Заморожена: не меняется и не перезапускается при изменениях схемы, они
+    идут шагами SCHEMA_MIGRATIONS. Все действия идемпотентны.
+    """
+    with db_transaction(immediate=True) as cursor:
+        ensure_bars_registry(cursor)
+        migrate_inventory_dates(cursor)
+        # даты — целые дни от 1970-01-01 (epoch-day), в API — 'YYYY-MM-DD'
         cursor.execute(f"""
-        CREATE TABLE IF NOT EXISTS {bar_name} (
+        CREATE TABLE IF NOT EXISTS {INVENTORY_TABLE} (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bar_id INTEGER NOT NULL,
             category TEXT,
             tob TEXT,
             name TEXT,
-            manufactured_at TEXT,
+            manufactured_at INTEGER,
             shelf_life_days INTEGER,
-            opened_at TEXT,
+            opened_at INTEGER,
             opened_shelf_life_days INTEGER,
-            opened INTEGER DEFAULT 0
+            opened INTEGER DEFAULT 0,
+            expiry_at INTEGER,
+            expiry_final INTEGER
+        )
+        """)
+        # (bar_id) с неявным id в конце — постраничный вывод бара по id без сортировки
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_bar ON {INVENTORY_TABLE} (bar_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_bar_tob ON {INVENTORY_TABLE} (bar_id, tob, opened)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_bar_expiry ON {INVENTORY_TABLE} (bar_id, expiry_final)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_inventory_bar_name ON {INVENTORY_TABLE} (bar_id, name)")
+        ensure_inventory_search_index(cursor)
+        ensure_inventory_archive(cursor)
+        ensure_bar_versions(cursor)
+        ensure_inventory_stats(cursor)
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {APP_STATE_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+        ensure_catalog(cursor)
+        ensure_change_journal(cursor)
+        # дневная сводка по срокам: одна строка на бар и день, items — JSON по группам
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {EXPIRY_DIGEST_TABLE} (
+            bar_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            items TEXT NOT NULL,
+            computed_at TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (bar_id, day)
+        )
+        """)
+        now = msk_now().strftime('%Y-%m-%d %H:%M:%S')
+        for bar_name in BARS:
+            cursor.execute(
+                f"INSERT OR IGNORE INTO {BARS_TABLE} (bar_name, created_at) VALUES (?, ?)", (bar_name, now)
+            )
+    for bar_id, bar_name in db_query(f"SELECT bar_id, bar_name FROM {BARS_TABLE} ORDER BY bar_id", fetch=True):
+        migrate_legacy_bar_table(bar_name, bar_id)
+    with db_transaction(immediate=True) as cursor:
+        fill_catalog_from_inventory(cursor)
+    db_query(f"PRAGMA user_version = {BASE_SCHEMA_USER_VERSION}")
+
+def ensure_bars_registry(cursor):
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({BARS_TABLE})")}
+    if 'bar_id' in columns:
+        return
+    cursor.execute(f"""
+    CREATE TABLE {BARS_TABLE}_new (
+        bar_id INTEGER PRIMARY KEY,
+        bar_name TEXT NOT NULL UNIQUE,
+        created_at TEXT
+    )
+    """)
+    if columns:
+        # старая таблица bars — только список названий
+        cursor.execute(
+            f"INSERT OR IGNORE INTO {BARS_TABLE}_new (bar_name) "
+            f"SELECT bar_name FROM {BARS_TABLE} WHERE bar_name IS NOT NULL ORDER BY rowid"
+        )
+        cursor.execute(f"DROP TABLE {BARS_TABLE}")
+    cursor.execute(f"ALTER TABLE {BARS_TABLE}_new RENAME TO {BARS_TABLE}")
+
+def migrate_inventory_dates(cursor):
+    """Пересобирает inventory с текстовыми датами в таблицу с epoch-day.
+
+    Нераспознанные даты становятся NULL (раньше они так же молча
+    игнорировались при расчёте срока); их число пишется в лог.
+    """
+    columns = {row[1]: row[2] for row in cursor.execute(f"PRAGMA table_info({INVENTORY_TABLE})")}
+    if columns.get('manufactured_at', 'INTEGER').upper() == 'INTEGER':
+        return
+    cursor.connection.create_function("legacy_day", 1, legacy_day, deterministic=True)
+    cursor.execute(f"""
+    CREATE TABLE {INVENTORY_TABLE}_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bar_id INTEGER NOT NULL,
+        category TEXT,
+        tob TEXT,
+        name TEXT,
+        manufactured_at INTEGER,
+        shelf_life_days INTEGER,
+        opened_at INTEGER,
+        opened_shelf_life_days INTEGER,
+        opened INTEGER DEFAULT 0,
+        expiry_at INTEGER,
+        expiry_final INTEGER
+    )
+    """)
+    cursor.execute(f"""
+    INSERT INTO {INVENTORY_TABLE}_new
+    SELECT id, bar_id, category, tob, name, manufactured_at, shelf_life_days, opened_at,
+           opened_shelf_life_days, opened, expiry_at, {EXPIRY_FINAL_SQL}
+    FROM (
+        SELECT id, bar_id, category, tob, name, legacy_day(manufactured_at) AS manufactured_at,
+               shelf_life_days, legacy_day(opened_at) AS opened_at, opened_shelf_life_days,
+               opened, legacy_day(expiry_at) AS expiry_at
+        FROM {INVENTORY_TABLE} ORDER BY id
+    )
+    """)
+    invalid = cursor.execute(f"""
+    SELECT COUNT(*) FROM {INVENTORY_TABLE} o JOIN {INVENTORY_TABLE}_new n USING (id)
+    WHERE (o.manufactured_at != '' AND n.manufactured_at IS NULL)
+       OR (o.opened_at != '' AND n.opened_at IS NULL)
+       OR (o.expiry_at != '' AND n.expiry_at IS NULL)
+    """).fetchone()[0]
+    seq = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (INVENTORY_TABLE,)).fetchone()
+    # FTS и триггеры пересоздаются дальше в ensure_schema
+    cursor.execute(f"DROP TABLE IF EXISTS {INVENTORY_TABLE}_fts")
+    cursor.execute(f"DROP TABLE {INVENTORY_TABLE}")
+    cursor.execute(f"ALTER TABLE {INVENTORY_TABLE}_new RENAME TO {INVENTORY_TABLE}")
+    if seq:
+        # не выдавать заново id удалённых позиций
+        cursor.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name=?", (seq[0], INVENTORY_TABLE))
+    print(f"[migrate] {INVENTORY_TABLE}: даты переведены в epoch-day, нераспознанных строк: {invalid}")
+
+def ensure_inventory_search_index(cursor):
+    """Триграммный FTS5-индекс по названиям, синхронизируется триггерами."""
+    fts = f"{INVENTORY_TABLE}_fts"
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (fts,)
+    ).fetchone()
+    if exists:
+        return
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE {fts} USING fts5("
+        f"name, content='{INVENTORY_TABLE}', content_rowid='id', tokenize='trigram')"
+    )
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {INVENTORY_TABLE} BEGIN
+        INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {INVENTORY_TABLE} BEGIN
+        INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """)
+    cursor.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF name ON {INVENTORY_TABLE} BEGIN
+        INSERT INTO {fts}({fts}, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO {fts}(rowid, name) VALUES (new.id, new.name);
+    END
+    """)
+    cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def ensure_bar_versions(cursor):
+    """Счётчик версий бара: триггеры увеличивают его при любой записи в inventory.
+
+    Счётчик хранится в базе, поэтому его видят все воркеры; отсутствие строки — версия 0.
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {BAR_VERSIONS_TABLE} (
+        bar_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+    """)
+    bump = (
+        f"INSERT INTO {BAR_VERSIONS_TABLE} (bar_id, version) SELECT {{row}}.bar_id, 1 WHERE {{cond}} "
+        f"ON CONFLICT(bar_id) DO UPDATE SET version = version + 1;"
+    )
+    for suffix, event, body in (
+        ('ai', 'INSERT', bump.format(row='new', cond='true')),
+        # при переносе позиции в другой бар меняются оба бара
+        ('au', 'UPDATE', bump.format(row='new', cond='true') + bump.format(row='old', cond='old.bar_id IS NOT new.bar_id')),
+        ('ad', 'DELETE', bump.format(row='old', cond='true')),
+    ):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {BAR_VERSIONS_TABLE}_{suffix}")
+        cursor.execute(f"""
+        CREATE TRIGGER {BAR_VERSIONS_TABLE}_{suffix} AFTER {event} ON {INVENTORY_TABLE} BEGIN
+            {body}
+        END
+        """)
+
+NO_EXPIRY_DAY = 2 ** 31 - 1  # expiry_day в inventory_stats для позиций без срока
+
+def ensure_inventory_stats(cursor):
+    """Агрегаты для /stats: число позиций и открытых по (бар, категория, день срока).
+
+    Поддерживаются триггерами на inventory, поэтому /stats читает несколько
+    сотен строк агрегатов вместо всех позиций. Просроченные и истекающие
+    считаются по дню срока относительно текущей даты. Агрегаты
+    пересчитываются с нуля один раз — в шаге 0 (ensure_base_schema).
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {INVENTORY_STATS_TABLE} (
+        bar_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        expiry_day INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        opened INTEGER NOT NULL,
+        PRIMARY KEY (bar_id, category, expiry_day)
+    ) WITHOUT ROWID
+    """)
+    def key(row):
+        return f"{row}.bar_id, COALESCE({row}.category, ''), COALESCE({row}.expiry_final, {NO_EXPIRY_DAY})"
+    def is_opened(row):
+        return f"(COALESCE({row}.opened, 0) != 0)"
+    add = (
+        f"INSERT INTO {INVENTORY_STATS_TABLE} (bar_id, category, expiry_day, total, opened) "
+        f"VALUES ({key('new')}, 1, {is_opened('new')}) "
+        f"ON CONFLICT(bar_id, category, expiry_day) DO UPDATE SET total = total + 1, opened = opened + excluded.opened;"
+    )
+    remove = (
+        f"UPDATE {INVENTORY_STATS_TABLE} SET total = total - 1, opened = opened - {is_opened('old')} "
+        f"WHERE (bar_id, category, expiry_day) = ({key('old')});"
+        f"DELETE FROM {INVENTORY_STATS_TABLE} WHERE (bar_id, category, expiry_day) = ({key('old')}) AND total <= 0;"
+    )
+    for suffix, event, body in (
+        ('ai', 'INSERT', add),
+        ('au', 'UPDATE OF bar_id, category, opened, expiry_final', remove + add),
+        ('ad', 'DELETE', remove),
+    ):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {INVENTORY_STATS_TABLE}_{suffix}")
+        cursor.execute(f"""
+        CREATE TRIGGER {INVENTORY_STATS_TABLE}_{suffix} AFTER {event} ON {INVENTORY_TABLE} BEGIN
+            {body}
+        END
+        """)
+    cursor.execute(f"DELETE FROM {INVENTORY_STATS_TABLE}")
+    cursor.execute(f"""
+    INSERT INTO {INVENTORY_STATS_TABLE} (bar_id, category, expiry_day, total, opened)
+    SELECT bar_id, COALESCE(category, ''), COALESCE(expiry_final, {NO_EXPIRY_DAY}), COUNT(*),
+           SUM(COALESCE(opened, 0) != 0)
+    FROM {INVENTORY_TABLE} GROUP BY 1, 2, 3
+    """)
+
+def ensure_catalog(cursor):
+    """Справочник товаров по tob: значения по умолчанию для /add и /open и автодополнение.
+
+    Позиции по-прежнему хранят свои название, категорию и сроки (по ним
+    работают поиск, агрегаты и расчёт сроков), справочник лишь подставляет
+    недостающие поля. Триггеры увеличивают catalog_version в app_state — по
+    нему воркеры понимают, что индекс в памяти устарел.
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+        tob TEXT PRIMARY KEY,
+        name TEXT,
+        category TEXT,
+        shelf_life_days INTEGER,
+        opened_shelf_life_days INTEGER,
+        updated_at TEXT
+    )
+    """)
+    for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE')):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {CATALOG_TABLE}_version_{suffix}")
+        cursor.execute(f"""
+        CREATE TRIGGER {CATALOG_TABLE}_version_{suffix} AFTER {event} ON {CATALOG_TABLE} BEGIN
+            INSERT INTO {APP_STATE_TABLE} (key, value) VALUES ('catalog_version', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1;
+        END
+        """)
+
+def fill_catalog_from_inventory(cursor):
+    """Первое наполнение справочника — по последней позиции с каждым tob."""
+    cursor.execute(f"""
+    INSERT OR IGNORE INTO {CATALOG_TABLE} (tob, name, category, shelf_life_days, opened_shelf_life_days, updated_at)
+    SELECT tob, name, category, shelf_life_days, opened_shelf_life_days, ?
+    FROM {INVENTORY_TABLE}
+    WHERE id IN (SELECT MAX(id) FROM {INVENTORY_TABLE} WHERE tob IS NOT NULL AND tob != '' GROUP BY tob)
+    """, (msk_now().strftime('%Y-%m-%d %H:%M:%S'),))
+
+def ensure_inventory_archive(cursor):
+    """Архив: закрытые и давно просроченные позиции, перенесённые из inventory.
+
+    Колонки те же, id сохраняется, поэтому архив читается теми же запросами,
+    что и рабочая таблица. Поиска по триграммам в архиве нет — это история,
+    её смотрят редко и явно (параметр archived в /search и /expired).
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (
+        id INTEGER PRIMARY KEY,
+        bar_id INTEGER NOT NULL,
+        category TEXT,
+        tob TEXT,
+        name TEXT,
+        manufactured_at INTEGER,
+        shelf_life_days INTEGER,
+        opened_at INTEGER,
+        opened_shelf_life_days INTEGER,
+        opened INTEGER DEFAULT 0,
+        expiry_at INTEGER,
+        expiry_final INTEGER,
+        archived_at TEXT,
+        reason TEXT
+    )
+    """)
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_archive_bar ON {ARCHIVE_TABLE} (bar_id)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_archive_bar_tob ON {ARCHIVE_TABLE} (bar_id, tob)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_archive_bar_expiry ON {ARCHIVE_TABLE} (bar_id, expiry_final)")
+
+def ensure_change_journal(cursor):
+    """Журнал изменений: триггеры пишут каждую запись в change_log.
+
+    Триггеры пересоздаются по текущим колонкам таблиц; вызывается в шаге 0
+    (ensure_base_schema) и шагами SCHEMA_MIGRATIONS, которые меняют колонки
+    журналируемых таблиц. Удаление пишется только с rowid.
+    """
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL,
+        op TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        data TEXT,
+        ts INTEGER NOT NULL
+    )
+    """)
+    for table in JOURNAL_TABLES:
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        for suffix in ('ai', 'au', 'ad'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS journal_{table}_{suffix}")
+        if not columns:
+            continue
+        row_json = "json_object(" + ", ".join(f"'{c}', new.{c}" for c in columns) + ")"
+        for suffix, event, op, row, data in (
+            ('ai', 'INSERT', 'upsert', 'new', row_json),
+            ('au', 'UPDATE', 'upsert', 'new', row_json),
+            ('ad', 'DELETE', 'delete', 'old', 'NULL'),
+        ):
+            cursor.execute(f"""
+            CREATE TRIGGER journal_{table}_{suffix} AFTER {event} ON {table} BEGIN
+                INSERT INTO {CHANGE_LOG_TABLE} (tbl, op, row_id, data, ts)
+                VALUES ('{table}', '{op}', {row}.rowid, {data}, CAST(strftime('%s', 'now') AS INTEGER));
+            END
+            """)
+
+def last_journal_seq(cursor):
+    """Последний выданный seq журнала; sqlite_sequence помнит его и после очистки change_log."""
+    res = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (CHANGE_LOG_TABLE,)).fetchone()
+    return res[0] if res else 0
+
+# --- Шаги миграции поверх базовой схемы ---
+# Каждый шаг — (версия, описание, функция(cursor)), выполняется один раз в своей
+# транзакции и записывается в schema_version. Шаги только добавляются в конец.
+
+def migrate_users_invites_indexes(cursor):
+    # users и invites создавались вне app.py; на новой базе создаём их в том же виде
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {USERS_TABLE} (user_id TEXT, username TEXT, bar_name TEXT, registered_at TEXT)")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {INVITES_TABLE} (code TEXT, bar_name TEXT, used TEXT, issued_at TEXT)")
+    # не UNIQUE: в старых базах возможны дубли, а миграция не должна падать на данных
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_users_user_id ON {USERS_TABLE} (user_id)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_users_bar_name ON {USERS_TABLE} (bar_name)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_invites_code ON {INVITES_TABLE} (code)")
+    ensure_change_journal(cursor)  # журнальные триггеры для только что созданных таблиц
+
+def migrate_open_expiry(cursor):
+    # /open писал срок после вскрытия только в shelf_life_days и expiry_at,
+    # поэтому expiry_final у таких позиций оставался NULL: переносим срок
+    # в opened_shelf_life_days, без даты производства итоговый срок — по вскрытию
+    for table in (INVENTORY_TABLE, ARCHIVE_TABLE):
+        cursor.execute(f"""
+        UPDATE {table}
+           SET opened_shelf_life_days = shelf_life_days, expiry_final = expiry_at
+         WHERE manufactured_at IS NULL AND opened_shelf_life_days IS NULL
+           AND opened_at IS NOT NULL AND shelf_life_days
+           AND expiry_at = opened_at + shelf_life_days
+        """)
+
+BASE_SCHEMA_STEP = (0, "базовая схема (ensure_base_schema)")
+
+# шаги после базовой схемы: (версия, описание, migrate(cursor)); каждый
+# выполняется один раз в своей транзакции записи, версии только растут.
+# Шаг, добавляющий колонку в inventory или другую таблицу из JOURNAL_TABLES,
+# должен сам вызвать ensure_change_journal(cursor): триггеры журнала
+# перечисляют колонки явно и иначе молча теряют новую
+SCHEMA_MIGRATIONS = (
+    (1, "users и invites: индексы по user_id, bar_name и code", migrate_users_invites_indexes),
+    (2, "позиции из /open: срок после вскрытия и expiry_final", migrate_open_expiry),
+)
+
+def apply_schema_migrations():
+    """Применяет шаги, которых ещё нет в schema_version: шаг 0, затем SCHEMA_MIGRATIONS.
+
+    Шаг 0 — ensure_base_schema: она сама открывает короткие транзакции
+    (перенос баров по одному), поэтому идёт вне общей транзакции шага.
+    База, размеченная до schema_version через PRAGMA user_version, считается
+    прошедшей шаг 0 без повторного запуска.
+    """
+    if db_query("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (SCHEMA_VERSION_TABLE,), fetch=True):
+        applied = {r[0] for r in db_query(f"SELECT version FROM {SCHEMA_VERSION_TABLE}", fetch=True)}
+    else:
+        applied = set()
+    version, description = BASE_SCHEMA_STEP
+    if version not in applied:
+        if db_query("PRAGMA user_version", fetch=True)[0][0] < BASE_SCHEMA_USER_VERSION:
+            ensure_base_schema()
+        record_schema_step(version, description, lambda cursor: None)
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version not in applied:
+            record_schema_step(version, description, migrate)
+
+def record_schema_step(version, description, migrate):
+    """migrate(cursor) и запись шага в schema_version одной транзакцией записи."""
+    with db_transaction(immediate=True) as cursor:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
         )
         """)
-        conn.commit()
+        # другой процесс мог применить шаг, пока мы ждали блокировку
+        if cursor.execute(f"SELECT 1 FROM {SCHEMA_VERSION_TABLE} WHERE version=?", (version,)).fetchone():
+            return
+        migrate(cursor)
+        cursor.execute(
+            f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, msk_now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+    print(f"[schema] применена миграция {version}: {description}")
+
+def get_app_state(key, default=None):
+    res = db_query(f"SELECT value FROM {APP_STATE_TABLE} WHERE key=?", (key,), fetch=True)
+    return res[0][0] if res else default
+
+def set_app_state(key, value):
+    db_query(
+        f"INSERT INTO {APP_STATE_TABLE} (key, value) VALUES (?, ?) "
+        f"ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, str(value))
+    )
+
+def get_bar_id(bar_name):
+    bar_id = _bar_ids.get(bar_name)
+    if bar_id is not None:
+        return bar_id
+    ensure_schema()
+    res = db_query(f"SELECT bar_id FROM {BARS_TABLE} WHERE bar_name=?", (bar_name,), fetch=True)
+    if not res:
+        raise Exception("Неизвестный бар")
+    bar_id = res[0][0]
+    with _schema_lock:
+        _bar_ids[bar_name] = bar_id
+    return bar_id
+
+def migrate_legacy_bar_table(bar_name, bar_id):
+    """Переносит позиции из старой таблицы бара (одна таблица на бар) в inventory.
+
+    Каждый бар переносится отдельной короткой транзакцией, поэтому перенос
+    не держит блокировку записи на всё время миграции.
+    """
+    with db_transaction(immediate=True) as cursor:
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (bar_name,)
+        ).fetchone()
+        if not exists:
+            return
+        table = '"' + bar_name.replace('"', '""') + '"'
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        def col(name):
+            return name if name in columns else "NULL"
+        cursor.connection.create_function("legacy_day", 1, legacy_day, deterministic=True)
+        cursor.execute(f"""
+        INSERT INTO {INVENTORY_TABLE} (bar_id, category, tob, name, manufactured_at, shelf_life_days,
+                                       opened_at, opened_shelf_life_days, opened, expiry_at, expiry_final)
+        SELECT ?, category, tob, name, manufactured_at, shelf_life_days, opened_at,
+               opened_shelf_life_days, opened, expiry_at, {EXPIRY_FINAL_SQL}
+        FROM (
+            SELECT {col('category')} AS category, {col('tob')} AS tob, {col('name')} AS name,
+                   legacy_day({col('manufactured_at')}) AS manufactured_at,
+                   {col('shelf_life_days')} AS shelf_life_days,
+                   legacy_day({col('opened_at')}) AS opened_at,
+                   {col('opened_shelf_life_days')} AS opened_shelf_life_days,
+                   COALESCE({col('opened')}, 0) AS opened, legacy_day({col('expiry_at')}) AS expiry_at
+            FROM {table} ORDER BY id
+        )
+        """, (bar_id,))
+        moved = cursor.rowcount
+        cursor.execute(f'DROP TABLE IF EXISTS "{bar_name.replace(chr(34), chr(34) * 2)}_fts"')
+        cursor.execute(f"DROP TABLE {table}")
+    print(f"[migrate] {bar_name}: перенесено позиций в {INVENTORY_TABLE}: {moved}")
 
 def migrate_all_bars():
-    for bar in BARS:
-        ensure_bar_table(bar)
+    ensure_schema()
 
 def db_query(sql, params=(), fetch=False):
+    cursor = get_db().cursor()
+    cursor.execute(sql, params)
+    if fetch:
+        return cursor.fetchall()
+    return None
+
+def db_iter(sql, params=(), batch_size=500):
+    """Строки выборки по мере чтения, без загрузки всего результата в память."""
+    cursor = get_db().cursor()
     try:
-        if not os.path.exists(SQLITE_DB):
-            raise Exception(f"Файл базы не найден: {SQLITE_DB}")
-        with sqlite3.connect(SQLITE_DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql, params)
-            if fetch:
-                return cursor.fetchall()
-            conn.commit()
-            return None
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+# --- Запись: напрямую или через очередь с групповым коммитом ---
+WRITE_QUEUE_ENABLED = os.getenv("WRITE_QUEUE", "0") == "1"
+WRITE_QUEUE_WINDOW_MS = float(os.getenv("WRITE_QUEUE_WINDOW_MS", 2))
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", 256))
+
+_write_queue = SimpleNamespace(queue=None, lock=threading.Lock())
+
+def run_write(fn):
+    """Выполняет fn(cursor) в транзакции записи и возвращает результат fn.
+
+    Транзакция всегда BEGIN IMMEDIATE: отложенная при конкурентной записи
+    получает "database is locked" без ожидания busy_timeout. С WRITE_QUEUE=1
+    операции выполняет один поток-писатель: всё, что пришло за
+    WRITE_QUEUE_WINDOW_MS, уходит одной транзакцией и одним fsync. Каждая
+    операция — в своём SAVEPOINT, её ошибка откатывает только её и
+    достаётся только её автору.
+    """
+    if not WRITE_QUEUE_ENABLED or getattr(_db_local, 'depth', 0):
+        # внутри уже открытой транзакции ждать писателя нельзя — он упрётся в нашу блокировку
+        with db_transaction(immediate=True) as cursor:
+            return fn(cursor)
+    future = Future()
+    writer_queue().put((fn, future))
+    return future.result()
+
+def writer_queue():
+    with _write_queue.lock:
+        if _write_queue.queue is None:
+            _write_queue.queue = queue.Queue()
+            threading.Thread(target=write_loop, args=(_write_queue.queue,), daemon=True, name="db-writer").start()
+        return _write_queue.queue
+
+def write_loop(ops):
+    while True:
+        batch = [ops.get()]
+        deadline = time.monotonic() + WRITE_QUEUE_WINDOW_MS / 1000
+        while len(batch) < WRITE_QUEUE_MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(ops.get(timeout=timeout))
+            except queue.Empty:
+                break
+        apply_write_batch(batch)
+
+def apply_write_batch(batch):
+    outcomes = []
+    try:
+        with db_transaction(immediate=True) as cursor:
+            for fn, _ in batch:
+                cursor.execute("SAVEPOINT write_op")
+                try:
+                    outcomes.append((True, fn(cursor)))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write_op")
+                    outcomes.append((False, e))
+                cursor.execute("RELEASE write_op")
     except Exception as e:
-        raise
+        # не удалось закоммитить — ошибка у всех операций пачки
+        for _, future in batch:
+            future.set_exception(e)
+        return
+    metric_observe('write_queue_batch_size', len(batch), buckets=COUNT_BUCKETS)
+    # результаты отдаём только после COMMIT
+    for (_, future), (ok, value) in zip(batch, outcomes):
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+# --- Кэш пользователь -> бар ---
+USER_BAR_CACHE_TTL = int(os.getenv("USER_BAR_CACHE_TTL", 300))  # секунды
+USER_BAR_CACHE_SIZE = int(os.getenv("USER_BAR_CACHE_SIZE", 1024))
+
+_user_bar_cache = OrderedDict()  # str(user_id) -> (bar_name, expires_at)
+_user_bar_lock = threading.Lock()
+
+def invalidate_user_cache(user_id=None):
+    """Сбрасывает кэш для одного пользователя или целиком (после восстановления базы)."""
+    with _user_bar_lock:
+        if user_id is None:
+            _user_bar_cache.clear()
+        else:
+            _user_bar_cache.pop(str(user_id), None)
 
 def get_user_bar(user_id):
+    key = str(user_id)
+    with _user_bar_lock:
+        cached = _user_bar_cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            _user_bar_cache.move_to_end(key)
+            return cached[0]
     try:
         res = db_query(f"SELECT bar_name FROM {USERS_TABLE} WHERE user_id=?", (user_id,), fetch=True)
-        return res[0][0] if res else None
     except Exception as e:
         return None
+    bar_name = res[0][0] if res else None
+    if bar_name is not None:
+        with _user_bar_lock:
+            _user_bar_cache[key] = (bar_name, time.monotonic() + USER_BAR_CACHE_TTL)
+            _user_bar_cache.move_to_end(key)
+            while len(_user_bar_cache) > USER_BAR_CACHE_SIZE:
+                _user_bar_cache.popitem(last=False)
+    return bar_name
 
 def check_user_access(user_id):
     try:
@@ -95,12 +1160,11 @@ def check_user_access(user_id):
     except Exception as e:
         return False
 
-def get_bar_table(user_id):
+def get_user_bar_id(user_id):
     bar_name = get_user_bar(user_id)
-    if bar_name in BARS:
-        ensure_bar_table(bar_name)
-        return bar_name
-    return None
+    if bar_name is None:
+        return None
+    return get_bar_id(bar_name)
 
 def msk_now():
     return datetime.now(MSK_TZ)
@@ -108,26 +1172,49 @@ def msk_now():
 def msk_today_str():
     return msk_now().strftime('%Y-%m-%d')
 
-def calc_expiry_by_total(manufactured_at, shelf_life_days):
-    if not manufactured_at or not shelf_life_days:
+# --- Даты: в базе epoch-day (целое число дней от 1970-01-01) ---
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def msk_today():
+    return msk_now().toordinal() - EPOCH_ORDINAL
+
+def parse_day(value):
+    """'YYYY-MM-DD' из запроса -> epoch-day; пустое значение -> None."""
+    if value is None or value == '':
         return None
     try:
-        return (datetime.strptime(manufactured_at, '%Y-%m-%d') + timedelta(days=int(shelf_life_days))).strftime('%Y-%m-%d')
-    except:
-        return None
+        return datetime.strptime(value, '%Y-%m-%d').toordinal() - EPOCH_ORDINAL
+    except (TypeError, ValueError):
+        raise ValueError(f"Некорректная дата: {value!r}, ожидается ГГГГ-ММ-ДД")
 
-def calc_expiry_by_opened(opened_at, opened_shelf_life_days):
-    if not opened_at or not opened_shelf_life_days:
-        return None
+def legacy_day(value):
+    """Текстовая дата из старой схемы; нераспознанная -> None, как и раньше."""
     try:
-        return (datetime.strptime(opened_at, '%Y-%m-%d') + timedelta(days=int(opened_shelf_life_days))).strftime('%Y-%m-%d')
-    except:
+        return parse_day(value)
+    except ValueError:
         return None
 
-def min_date(date1, date2):
-    if date1 and date2:
-        return min(date1, date2)
-    return date1 or date2
+@functools.lru_cache(maxsize=65536)
+def format_day(day):
+    if day is None:
+        return None
+    return date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+# сроки считаются в SQL по колонкам позиции; нулевой срок — «не задан»
+EXPIRY_BY_TOTAL_SQL = "(CASE WHEN shelf_life_days THEN manufactured_at + shelf_life_days END)"
+EXPIRY_BY_OPENED_SQL = "(CASE WHEN opened_shelf_life_days THEN opened_at + opened_shelf_life_days END)"
+EXPIRY_FINAL_SQL = (
+    f"MIN(COALESCE({EXPIRY_BY_TOTAL_SQL}, {EXPIRY_BY_OPENED_SQL}), "
+    f"COALESCE({EXPIRY_BY_OPENED_SQL}, {EXPIRY_BY_TOTAL_SQL}))"
+)
+
+def calc_expiry_final(manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days):
+    """То же, что EXPIRY_FINAL_SQL, для значений, которые ещё не записаны в базу."""
+    by_total = manufactured_at + shelf_life_days if manufactured_at is not None and shelf_life_days else None
+    by_opened = opened_at + opened_shelf_life_days if opened_at is not None and opened_shelf_life_days else None
+    if by_total is not None and by_opened is not None:
+        return min(by_total, by_opened)
+    return by_total if by_total is not None else by_opened
 
 @app.route('/userinfo', methods=['POST'])
 def api_userinfo():
@@ -144,6 +1231,160 @@ def api_userinfo():
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
+# --- Справочник товаров (tob -> название, категория, сроки) ---
+CATALOG_FIELDS = ('name', 'category', 'shelf_life_days', 'opened_shelf_life_days')
+CATALOG_COMPLETE_LIMIT = 20
+CATALOG_REFRESH_SECONDS = 2  # как часто индекс автодополнения может перечитываться при изменениях
+
+_catalog_lock = threading.Lock()
+# keys — отсортированные (префикс-ключ, tob)
+_catalog = SimpleNamespace(version=None, by_tob={}, keys=[], loaded_at=0.0)
+
+def load_catalog():
+    """Индекс автодополнения в памяти.
+
+    Перечитывается, если изменился catalog_version, но не чаще раза в
+    CATALOG_REFRESH_SECONDS: при потоке новых товаров подсказки отстают на
+    пару секунд, зато запросы не пересобирают индекс каждый раз.
+    """
+    ensure_schema()
+    if _catalog.version is not None and time.monotonic() - _catalog.loaded_at < CATALOG_REFRESH_SECONDS:
+        return _catalog
+    with db_transaction() as cursor:
+        res = cursor.execute(f"SELECT value FROM {APP_STATE_TABLE} WHERE key='catalog_version'").fetchone()
+        version = (_db_local.file_id, res[0] if res else None)
+        if version == _catalog.version:
+            _catalog.loaded_at = time.monotonic()
+            return _catalog
+        rows = cursor.execute(
+            f"SELECT tob, {', '.join(CATALOG_FIELDS)} FROM {CATALOG_TABLE}"
+        ).fetchall()
+    by_tob = {}
+    keys = []
+    for row in rows:
+        tob = row[0]
+        by_tob[tob] = dict(zip(('tob',) + CATALOG_FIELDS, row))
+        keys.append((tob, tob))
+        name = (row[1] or '').casefold().strip()
+        if name:
+            # и по началу названия, и по началу каждого слова
+            keys.append((name, tob))
+            keys.extend((word, tob) for word in name.split()[1:])
+    keys.sort()
+    with _catalog_lock:
+        if _catalog.version != version:
+            _catalog.by_tob, _catalog.keys, _catalog.version = by_tob, keys, version
+        _catalog.loaded_at = time.monotonic()
+    return _catalog
+
+def catalog_complete(prefix, limit=CATALOG_COMPLETE_LIMIT):
+    """Товары, у которых tob, название или слово в названии начинается с prefix."""
+    catalog = load_catalog()
+    prefix = prefix.strip().casefold()
+    keys, by_tob = catalog.keys, catalog.by_tob
+    found = {}
+    i = bisect.bisect_left(keys, (prefix,))
+    while i < len(keys) and len(found) < limit and keys[i][0].startswith(prefix):
+        found.setdefault(keys[i][1], by_tob[keys[i][1]])
+        i += 1
+    return list(found.values())
+
+def catalog_entry(tob):
+    """Товар по tob — один поиск по первичному ключу."""
+    if not tob:
+        return None
+    ensure_schema()
+    res = db_query(f"SELECT {', '.join(CATALOG_FIELDS)} FROM {CATALOG_TABLE} WHERE tob=?", (tob,), fetch=True)
+    return dict(zip(CATALOG_FIELDS, res[0])) if res else None
+
+def with_catalog_defaults(d, fields=CATALOG_FIELDS, entry=None):
+    """Запрос, дополненный полями из справочника для его tob (переданные значения важнее)."""
+    if entry is None:
+        entry = catalog_entry(d.get('tob'))
+    if not entry:
+        return d
+    merged = dict(d)
+    for field in fields:
+        if merged.get(field) in (None, '') and entry.get(field) is not None:
+            merged[field] = entry[field]
+    return merged
+
+CATALOG_UPSERT_SQL = (
+    f"INSERT INTO {CATALOG_TABLE} (tob, name, category, shelf_life_days, opened_shelf_life_days, updated_at) "
+    f"VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(tob) DO UPDATE SET "
+    + ", ".join(f"{f} = COALESCE(excluded.{f}, {f})" for f in CATALOG_FIELDS) + ", updated_at = excluded.updated_at "
+    f"WHERE ({', '.join(CATALOG_FIELDS)}) IS NOT ("
+    + ", ".join(f"COALESCE(excluded.{f}, {f})" for f in CATALOG_FIELDS) + ")"
+)
+
+def remember_in_catalog(cursor, tob, name=None, category=None, shelf_life_days=None, opened_shelf_life_days=None):
+    """Запоминает товар; пустые значения не затирают уже известные, неизменные не пишутся."""
+    if not tob:
+        return
+    cursor.execute(CATALOG_UPSERT_SQL, (
+        tob, name or None, category or None, shelf_life_days, opened_shelf_life_days,
+        msk_now().strftime('%Y-%m-%d %H:%M:%S')
+    ))
+
+@app.route('/catalog', methods=['POST'])
+def api_catalog():
+    data = request.get_json()
+    user_id = data.get('user_id')
+    try:
+        if not user_id or not check_user_access(user_id):
+            return jsonify(ok=False, error="Нет доступа")
+        limit = min(int(data.get('limit') or CATALOG_COMPLETE_LIMIT), 100)
+        return jsonify(ok=True, results=catalog_complete(str(data.get('query', '')), limit))
+    except Exception as e:
+        return jsonify(ok=False, error=str(e))
+
+BAR_INSERT_SQL = (
+    f"INSERT INTO {INVENTORY_TABLE} (bar_id, category, tob, name, manufactured_at, shelf_life_days, opened_at, "
+    f"opened_shelf_life_days, opened, expiry_final) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+BAR_EXPIRY_UPDATE_SQL = f"UPDATE {INVENTORY_TABLE} SET expiry_final = {EXPIRY_FINAL_SQL} WHERE id=?"
+BAR_UPDATE_FIELDS = ('category', 'name', 'manufactured_at', 'shelf_life_days', 'opened_at', 'opened_shelf_life_days', 'opened')
+BAR_DATE_FIELDS = ('manufactured_at', 'opened_at')
+BATCH_MAX_ITEMS = 500
+
+def add_item_params(d):
+    """Проверяет данные новой позиции и возвращает параметры для BAR_INSERT_SQL."""
+    # обязательные поля
+    manufactured_at = parse_day(d['manufactured_at'])
+    if manufactured_at is None:
+        raise ValueError("Не указана дата производства")
+    shelf_life_days = int(d['shelf_life_days'])
+    opened = int(d.get('opened', 0))
+    opened_at = parse_day(d.get('opened_at'))
+    opened_shelf_life_days = d.get('opened_shelf_life_days')
+    if opened_shelf_life_days is not None:
+        opened_shelf_life_days = int(opened_shelf_life_days)
+    return (
+        d['category'],
+        d['tob'],
+        d['name'],
+        manufactured_at,
+        shelf_life_days,
+        opened_at,
+        opened_shelf_life_days,
+        opened,
+        calc_expiry_final(manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days)
+    )
+
+def remember_added_item(cursor, params):
+    """Заносит в справочник товар из параметров add_item_params."""
+    category, tob, name, _, shelf_life_days, _, opened_shelf_life_days = params[:7]
+    remember_in_catalog(cursor, tob, name, category, shelf_life_days, opened_shelf_life_days)
+
+def update_item_fields(d):
+    fields = []
+    params = []
+    for field in BAR_UPDATE_FIELDS:
+        if field in d:
+            fields.append(f"{field}=?")
+            params.append(parse_day(d[field]) if field in BAR_DATE_FIELDS else d[field])
+    return fields, params
+
 @app.route('/add', methods=['POST'])
 def api_add():
     data = request.get_json()
@@ -151,34 +1392,15 @@ def api_add():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
-        d = data
-        # обязательные поля
-        manufactured_at = d['manufactured_at']
-        shelf_life_days = int(d['shelf_life_days'])
-        opened = int(d.get('opened', 0))
-        opened_at = d.get('opened_at')
-        opened_shelf_life_days = d.get('opened_shelf_life_days')
-        if opened_shelf_life_days is not None:
-            opened_shelf_life_days = int(opened_shelf_life_days)
-        with sqlite3.connect(SQLITE_DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                f"INSERT INTO {bar_table} (category, tob, name, manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days, opened) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    d['category'],
-                    d['tob'],
-                    d['name'],
-                    manufactured_at,
-                    shelf_life_days,
-                    opened_at,
-                    opened_shelf_life_days,
-                    opened
-                )
-            )
+        bar_id = get_user_bar_id(user_id)
+        data = with_catalog_defaults(data)
+        params = add_item_params(data)
+        def write(cursor):
+            cursor.execute(BAR_INSERT_SQL, (bar_id,) + params)
             new_id = cursor.lastrowid
-            conn.commit()
-        return jsonify(ok=True, id=new_id)
+            remember_added_item(cursor, params)
+            return new_id
+        return jsonify(ok=True, id=run_write(write))
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
@@ -189,40 +1411,242 @@ def api_open():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
+        bar_id = get_user_bar_id(user_id)
+        # в справочник пишем только то, что прислал клиент: подставленное из
+        # справочника или старой позиции туда возвращаться не должно
+        sent = {field: data.get(field) for field in ('name', 'category', 'shelf_life_days')}
+        if sent['shelf_life_days'] not in (None, ''):
+            sent['shelf_life_days'] = int(sent['shelf_life_days'])
+        # в /open shelf_life_days — срок после вскрытия: по умолчанию берём его из справочника
+        entry = catalog_entry(data.get('tob')) or {}
+        if data.get('shelf_life_days') in (None, '') and entry.get('opened_shelf_life_days'):
+            data = dict(data, shelf_life_days=entry['opened_shelf_life_days'])
+        data = with_catalog_defaults(data, ('name', 'category'), entry)
         tob = data['tob']
         category = data['category']
         name = data['name']
-        today = msk_today_str()
-        res = db_query(f"SELECT id, shelf_life_days FROM {bar_table} WHERE tob=? AND opened=1", (tob,), fetch=True)
-        if res:
-            old_id, shelf_life_days = res[0]
-            db_query(f"UPDATE {bar_table} SET opened=0 WHERE id=?", (old_id,))
-            expiry_at = (msk_now() + timedelta(days=int(shelf_life_days))).strftime('%Y-%m-%d')
-            with sqlite3.connect(SQLITE_DB) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"INSERT INTO {bar_table} (category, tob, name, opened_at, shelf_life_days, expiry_at, opened) VALUES (?, ?, ?, ?, ?, ?, 1)",
-                    (category, tob, name, today, shelf_life_days, expiry_at)
-                )
-                new_id = cursor.lastrowid
-                conn.commit()
-            return jsonify(ok=True, replaced=True, id=new_id)
-        else:
-            shelf_life_days = int(data['shelf_life_days'])
-            expiry_at = (msk_now() + timedelta(days=shelf_life_days)).strftime('%Y-%m-%d')
-            with sqlite3.connect(SQLITE_DB) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    f"INSERT INTO {bar_table} (category, tob, name, opened_at, shelf_life_days, expiry_at, opened) VALUES (?, ?, ?, ?, ?, ?, 1)",
-                    (category, tob, name, today, shelf_life_days, expiry_at)
-                )
-                new_id = cursor.lastrowid
-                conn.commit()
-            return jsonify(ok=True, replaced=False, id=new_id)
+        today = msk_today()
+        # проверка и вставка в одной транзакции записи: два одновременных
+        # открытия одного tob не создадут две открытые бутылки
+        def write(cursor):
+            # срок после вскрытия: запрос -> справочник -> открытая бутылка
+            res = cursor.execute(
+                f"SELECT id, COALESCE(opened_shelf_life_days, shelf_life_days) FROM {INVENTORY_TABLE} "
+                f"WHERE bar_id=? AND tob=? AND opened=1 ORDER BY id DESC LIMIT 1",
+                (bar_id, tob)
+            ).fetchall()
+            shelf_life_days = data.get('shelf_life_days')
+            if res:
+                old_id, old_shelf_life_days = res[0]
+                cursor.execute(f"UPDATE {INVENTORY_TABLE} SET opened=0 WHERE id=?", (old_id,))
+                if shelf_life_days in (None, ''):
+                    shelf_life_days = old_shelf_life_days
+            if shelf_life_days in (None, ''):
+                raise Exception("Не указан срок хранения после вскрытия")
+            shelf_life_days = int(shelf_life_days)
+            expiry_at = today + shelf_life_days
+            cursor.execute(
+                f"INSERT INTO {INVENTORY_TABLE} (bar_id, category, tob, name, opened_at, shelf_life_days, opened_shelf_life_days, expiry_at, opened, expiry_final) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+                (bar_id, category, tob, name, today, shelf_life_days, shelf_life_days, expiry_at,
+                 calc_expiry_final(None, None, today, shelf_life_days))
+            )
+            new_id = cursor.lastrowid
+            remember_in_catalog(
+                cursor, tob, sent['name'], sent['category'], opened_shelf_life_days=sent['shelf_life_days'] or None
+            )
+            return bool(res), new_id
+        replaced, new_id = run_write(write)
+        return jsonify(ok=True, replaced=replaced, id=new_id)
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
+BAR_SELECT_COLUMNS = (
+    "id, category, tob, name, manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days, opened, "
+    f"{EXPIRY_BY_TOTAL_SQL}, {EXPIRY_BY_OPENED_SQL}"
+)
+
+ITEM_FIELDS = (
+    'id', 'category', 'tob', 'name', 'manufactured_at', 'shelf_life_days', 'opened_at',
+    'opened_shelf_life_days', 'opened', 'expiry_by_total', 'expiry_by_opened', 'expiry_final'
+)
+
+def bar_row(r):
+    """Строка выдачи в порядке ITEM_FIELDS."""
+    expiry_by_total, expiry_by_opened = r[9], r[10]
+    if expiry_by_total is None or (expiry_by_opened is not None and expiry_by_opened < expiry_by_total):
+        expiry_final = expiry_by_opened
+    else:
+        expiry_final = expiry_by_total
+    return (
+        r[0], r[1], r[2], r[3], format_day(r[4]), r[5], format_day(r[6]), r[7], r[8],
+        format_day(expiry_by_total), format_day(expiry_by_opened), format_day(expiry_final)
+    )
+
+def bar_item(r):
+    return dict(zip(ITEM_FIELDS, bar_row(r)))
+
+def page_params(data):
+    """limit/after из запроса; limit=-1 — без ограничения (как раньше)."""
+    return int(data.get('limit') or -1), int(data.get('after') or 0)
+
+# --- Формат и сжатие ответов /search и /expired ---
+# objects — массив объектов (как раньше); columns — имена полей один раз и строки массивами;
+# msgpack — то же, что columns, в MessagePack
+ITEM_FORMATS = ('objects', 'columns', 'msgpack')
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))  # мелкие ответы сжатие только удлиняет
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))  # 1 — вдвое быстрее, но тело примерно на 40% больше
+BROTLI_QUALITY = 5  # выше — заметно медленнее при почти том же размере
+
+def item_format(data):
+    fmt = data.get('format') or 'objects'
+    if fmt not in ITEM_FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}, ожидается {', '.join(ITEM_FORMATS)}")
+    if fmt == 'msgpack' and msgpack is None:
+        raise ValueError("Формат msgpack недоступен: на сервере не установлен пакет msgpack")
+    return fmt
+
+def dumps_json(obj):
+    """JSON в bytes: orjson, если установлен, иначе json без пробелов.
+
+    Стандартному json ensure_ascii не отключаем: с ним кодирование заметно быстрее.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def items_body(rows, limit, fmt, paged=True):
+    """Тело ответа со строками bar_row и его mimetype.
+
+    paged=False — строки не упорядочены по id (сортировка по релевантности),
+    курсора next_after для них нет.
+    """
+    next_after = rows[-1][0] if paged and limit > 0 and len(rows) == limit else None
+    if fmt == 'objects':
+        payload = {'ok': True, 'results': [dict(zip(ITEM_FIELDS, row)) for row in rows], 'next_after': next_after}
+    else:
+        payload = {'ok': True, 'columns': ITEM_FIELDS, 'rows': rows, 'next_after': next_after}
+    if fmt == 'msgpack':
+        return msgpack.packb(payload), 'application/msgpack'
+    return dumps_json(payload), 'application/json'
+
+def negotiate_encoding():
+    """Сжатие по Accept-Encoding: br (если есть brotli), иначе gzip, иначе None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+# --- Кэш ответов /search и /expired ---
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+# суммарный размер тел в кэше (вместе со сжатыми вариантами); тело больше
+# RESPONSE_CACHE_MAX_BODY не кэшируется вовсе — иначе пара выдач без limit вытесняет всё
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", 2 * 1024 * 1024))
+
+# (bar_id, endpoint, параметры, формат, день) -> (etag, mimetype, {сжатие или None: тело})
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_response_cache_bytes = 0
+
+def invalidate_response_cache():
+    global _response_cache_bytes
+    with _response_cache_lock:
+        _response_cache.clear()
+        _response_cache_bytes = 0
+
+def _cached_bytes(cached):
+    return sum(len(body) for body in cached[2].values())
+
+def store_cached_response(cache_key, cached):
+    """Кладёт ответ в кэш и вытесняет старые, пока кэш не влезет в лимиты."""
+    global _response_cache_bytes
+    if _cached_bytes(cached) > RESPONSE_CACHE_MAX_BODY:
+        return
+    with _response_cache_lock:
+        previous = _response_cache.pop(cache_key, None)
+        if previous is not None:
+            _response_cache_bytes -= _cached_bytes(previous)
+        _response_cache[cache_key] = cached
+        _response_cache_bytes += _cached_bytes(cached)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE or _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+            _, evicted = _response_cache.popitem(last=False)
+            _response_cache_bytes -= _cached_bytes(evicted)
+
+def store_compressed_body(cache_key, cached, encoding, body):
+    """Добавляет сжатый вариант к закэшированному ответу, если тот ещё в кэше."""
+    global _response_cache_bytes
+    with _response_cache_lock:
+        if _response_cache.get(cache_key) is not cached or encoding in cached[2]:
+            return
+        cached[2][encoding] = body
+        _response_cache_bytes += len(body)
+        while _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES and len(_response_cache) > 1:
+            _, evicted = _response_cache.popitem(last=False)
+            _response_cache_bytes -= _cached_bytes(evicted)
+
+def cached_items_response(bar_id, endpoint, key, sql, params, limit, stream=False, fmt='objects', paged=True):
+    """Позиции бара в формате fmt с кэшем по версии бара, ETag и сжатием.
+
+    ETag зависит от файла базы, версии бара, дня и параметров запроса, поэтому
+    клиент с актуальным If-None-Match получает 304 без чтения позиций.
+    Сжатые варианты тела кэшируются рядом с несжатым; у сжатого ответа
+    к ETag добавляется суффикс кодировки.
+    """
+    if stream:
+        return items_stream(sql, params)
+    cache_key = (bar_id, endpoint, key, fmt, msk_today_str())
+    encoding = negotiate_encoding()
+    with db_transaction() as cursor:
+        res = cursor.execute(f"SELECT version FROM {BAR_VERSIONS_TABLE} WHERE bar_id=?", (bar_id,)).fetchone()
+        etag = hashlib.blake2b(
+            repr((_db_local.file_id, res[0] if res else 0) + cache_key).encode(), digest_size=12
+        ).hexdigest()
+        for known in ((f"{etag}-{encoding}", etag) if encoding else (etag,)):
+            if request.if_none_match.contains(known):
+                resp = Response(status=304)
+                resp.set_etag(known)
+                resp.vary.add('Accept-Encoding')
+                return resp
+        with _response_cache_lock:
+            cached = _response_cache.get(cache_key)
+            if cached and cached[0] == etag:
+                _response_cache.move_to_end(cache_key)
+            else:
+                cached = None
+        if cached is None:
+            rows = [bar_row(r) for r in db_query(sql, params, fetch=True)]
+            body, mimetype = items_body(rows, limit, fmt, paged)
+            cached = (etag, mimetype, {None: body})
+            store_cached_response(cache_key, cached)
+    _, mimetype, bodies = cached
+    body = bodies.get(encoding)
+    if encoding is None or len(bodies[None]) < COMPRESS_MIN_BYTES:
+        encoding, body = None, bodies[None]
+    elif body is None:
+        # гонка двух потоков безвредна: оба сожмут одно и то же тело
+        body = compress_body(bodies[None], encoding)
+        store_compressed_body(cache_key, cached, encoding, body)
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    resp.vary.add('Accept-Encoding')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+def items_stream(sql, params):
+    """Позиции бара построчно (NDJSON) прямо из курсора."""
+    def generate():
+        for r in db_iter(sql, params):
+            yield dumps_json(bar_item(r)) + b"\n"
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/expired', methods=['POST'])
 def api_expired():
     data = request.get_json()
@@ -230,28 +1654,22 @@ def api_expired():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
-        now = msk_today_str()
-        select_columns = "id, category, tob, name, manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days, opened"
-        rows = db_query(
-            f"SELECT {select_columns} FROM {bar_table}", (), fetch=True
+        bar_id = get_user_bar_id(user_id)
+        now = msk_today()
+        limit, after = page_params(data)
+        archived = bool(data.get('archived'))
+        fmt = item_format(data)
+        # индекс по сроку явно: иначе планировщик выбирает проход по id ради ORDER BY
+        source = (
+            f"{ARCHIVE_TABLE} INDEXED BY idx_archive_bar_expiry" if archived
+            else f"{INVENTORY_TABLE} INDEXED BY idx_inventory_bar_expiry"
+        )
+        return cached_items_response(
+            bar_id, 'expired', (archived, limit, after),
+            f"SELECT {BAR_SELECT_COLUMNS} FROM {source} "
+            f"WHERE bar_id=? AND expiry_final IS NOT NULL AND expiry_final <= ? AND id > ? ORDER BY id LIMIT ?",
+            (bar_id, now, after, limit), limit, stream=bool(data.get('stream')), fmt=fmt
         )
-        results = []
-        for r in rows:
-            expiry_by_total = calc_expiry_by_total(r[4], r[5])
-            expiry_by_opened = calc_expiry_by_opened(r[6], r[7])
-            expiry_final = min_date(expiry_by_total, expiry_by_opened)
-            if expiry_final and expiry_final <= now:
-                results.append({
-                    'id': r[0], 'category': r[1], 'tob': r[2], 'name': r[3],
-                    'manufactured_at': r[4], 'shelf_life_days': r[5],
-                    'opened_at': r[6], 'opened_shelf_life_days': r[7],
-                    'opened': r[8],
-                    'expiry_by_total': expiry_by_total,
-                    'expiry_by_opened': expiry_by_opened,
-                    'expiry_final': expiry_final
-            })
-        return jsonify(ok=True, results=results)
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
@@ -262,36 +1680,45 @@ def api_search():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
-        query = data.get('query', '').strip().lower()
-        select_columns = "id, category, tob, name, manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days, opened"
+        bar_id = get_user_bar_id(user_id)
+        query = data.get('query', '').strip().casefold()
+        limit, after = page_params(data)
+        archived = bool(data.get('archived'))
+        fmt = item_format(data)
+        table = ARCHIVE_TABLE if archived else INVENTORY_TABLE
+        paged = True
         if not query:
-            rows = db_query(
-                f"SELECT {select_columns} FROM {bar_table}", (), fetch=True
-            )
+            sql = f"SELECT {BAR_SELECT_COLUMNS} FROM {table} WHERE bar_id=? AND id > ? ORDER BY id LIMIT ?"
+            params = (bar_id, after, limit)
         elif query.isdigit() and len(query) == 6:
-            rows = db_query(
-                f"SELECT {select_columns} FROM {bar_table} WHERE tob=?", (query,), fetch=True
-            )
+            sql = f"SELECT {BAR_SELECT_COLUMNS} FROM {table} WHERE bar_id=? AND tob=? AND id > ? ORDER BY id LIMIT ?"
+            params = (bar_id, query, after, limit)
+        elif len(query) < 3 or archived:
+            # триграммный индекс не ищет строки короче трёх символов; у архива его нет вовсе
+            sql = f"SELECT {BAR_SELECT_COLUMNS} FROM {table} WHERE bar_id=? AND casefold(name) LIKE ? AND id > ? ORDER BY id LIMIT ?"
+            params = (bar_id, f"%{query}%", after, limit)
         else:
-            rows = db_query(
-                f"SELECT {select_columns} FROM {bar_table} WHERE LOWER(name) LIKE ?", (f"%{query}%",), fetch=True
-            )
-        results = []
-        for r in rows:
-            expiry_by_total = calc_expiry_by_total(r[4], r[5])
-            expiry_by_opened = calc_expiry_by_opened(r[6], r[7])
-            expiry_final = min_date(expiry_by_total, expiry_by_opened)
-            results.append({
-                'id': r[0], 'category': r[1], 'tob': r[2], 'name': r[3],
-                'manufactured_at': r[4], 'shelf_life_days': r[5],
-                'opened_at': r[6], 'opened_shelf_life_days': r[7],
-                'opened': r[8],
-                'expiry_by_total': expiry_by_total,
-                'expiry_by_opened': expiry_by_opened,
-                'expiry_final': expiry_final
-            })
-        return jsonify(ok=True, results=results)
+            match = '"' + query.replace('"', '""') + '"'
+            fts_match = f"{INVENTORY_TABLE}_fts WHERE {INVENTORY_TABLE}_fts MATCH ?"
+            if data.get('rank'):
+                # FTS — внешний цикл (CROSS JOIN): иначе MATCH выполняется заново на каждую позицию бара;
+                # при сортировке по релевантности курсоров after/next_after нет — только первые limit
+                sql = (
+                    f"SELECT {BAR_SELECT_COLUMNS} FROM (SELECT rowid AS fts_id, rank AS fts_rank FROM {fts_match}) f "
+                    f"CROSS JOIN {INVENTORY_TABLE} ON id = f.fts_id WHERE bar_id=? ORDER BY f.fts_rank LIMIT ?"
+                )
+                params = (match, bar_id, limit)
+                paged = False
+            else:
+                sql = (
+                    f"SELECT {BAR_SELECT_COLUMNS} FROM {INVENTORY_TABLE} WHERE id IN (SELECT rowid FROM {fts_match}) "
+                    f"AND bar_id=? AND id > ? ORDER BY id LIMIT ?"
+                )
+                params = (match, bar_id, after, limit)
+        return cached_items_response(
+            bar_id, 'search', (archived, query, bool(data.get('rank')), limit, after),
+            sql, params, limit, stream=bool(data.get('stream')), fmt=fmt, paged=paged
+        )
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
@@ -302,20 +1729,20 @@ def api_update():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
+        bar_id = get_user_bar_id(user_id)
         item_id = data.get('id')
         if not item_id:
             return jsonify(ok=False, error="Не указан id позиции для обновления")
-        fields = []
-        params = []
-        for field in ('category', 'name', 'manufactured_at', 'shelf_life_days', 'opened_at', 'opened_shelf_life_days', 'opened'):
-            if field in data:
-                fields.append(f"{field}=?")
-                params.append(data[field])
-        params.append(item_id)
+        fields, params = update_item_fields(data)
         if not fields:
             return jsonify(ok=False, error="Нет данных для обновления")
-        db_query(f"UPDATE {bar_table} SET {', '.join(fields)} WHERE id=?", tuple(params))
+        def write(cursor):
+            cursor.execute(
+                f"UPDATE {INVENTORY_TABLE} SET {', '.join(fields)} WHERE id=? AND bar_id=?",
+                tuple(params) + (item_id, bar_id)
+            )
+            cursor.execute(BAR_EXPIRY_UPDATE_SQL, (item_id,))
+        run_write(write)
         return jsonify(ok=True)
     except Exception as e:
         return jsonify(ok=False, error=str(e))
@@ -327,18 +1754,162 @@ def api_delete():
     try:
         if not user_id or not check_user_access(user_id):
             return jsonify(ok=False, error="Нет доступа")
-        bar_table = get_bar_table(user_id)
+        bar_id = get_user_bar_id(user_id)
         item_id = data.get('id')
         if not item_id:
             return jsonify(ok=False, error="Не указан id позиции для удаления")
-        res = db_query(f"SELECT id FROM {bar_table} WHERE id=?", (item_id,), fetch=True)
-        if not res:
+        def write(cursor):
+            cursor.execute(f"DELETE FROM {INVENTORY_TABLE} WHERE id=? AND bar_id=?", (item_id, bar_id))
+            return cursor.rowcount
+        if not run_write(write):
             return jsonify(ok=False, error="Позиция с указанным id не найдена")
-        db_query(f"DELETE FROM {bar_table} WHERE id=?", (item_id,))
         return jsonify(ok=True)
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
+@app.route('/batch', methods=['POST'])
+def api_batch():
+    """Пачка операций add/update/delete в одной транзакции.
+
+    Сначала проверяются все операции: при любой ошибке в данных ничего не
+    записывается. Результаты возвращаются в том же порядке, что и операции.
+    """
+    data = request.get_json()
+    user_id = data.get('user_id')
+    try:
+        if not user_id or not check_user_access(user_id):
+            return jsonify(ok=False, error="Нет доступа")
+        bar_id = get_user_bar_id(user_id)
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify(ok=False, error="Нет операций")
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify(ok=False, error=f"Слишком много операций (максимум {BATCH_MAX_ITEMS})")
+        prepared = []
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                op = item.get('op')
+                if op == 'add':
+                    prepared.append((op, None, add_item_params(with_catalog_defaults(item))))
+                    continue
+                item_id = int(item['id'])
+                if op == 'update':
+                    fields, params = update_item_fields(item)
+                    if not fields:
+                        raise ValueError("Нет данных для обновления")
+                    prepared.append((op, item_id, (fields, params)))
+                elif op == 'delete':
+                    prepared.append((op, item_id, None))
+                else:
+                    raise ValueError(f"Неизвестная операция: {op}")
+            except KeyError as e:
+                errors.append({'index': index, 'error': f"Не указано поле {e}"})
+            except (AttributeError, TypeError, ValueError) as e:
+                errors.append({'index': index, 'error': str(e)})
+        if errors:
+            return jsonify(ok=False, error="Ошибка в данных", errors=errors)
+
+        def write(cursor):
+            results = []
+            deleted_ids = []
+            updated_ids = []
+            ids = [item_id for _, item_id, _ in prepared if item_id is not None]
+            existing = set()
+            if ids:
+                placeholders = ", ".join("?" * len(ids))
+                existing = {row[0] for row in cursor.execute(
+                    f"SELECT id FROM {INVENTORY_TABLE} WHERE bar_id=? AND id IN ({placeholders})", [bar_id] + ids
+                )}
+            for op, item_id, payload in prepared:
+                if op == 'add':
+                    cursor.execute(BAR_INSERT_SQL, (bar_id,) + payload)
+                    results.append({'ok': True, 'id': cursor.lastrowid})
+                    remember_added_item(cursor, payload)
+                elif item_id not in existing:
+                    results.append({'ok': False, 'id': item_id, 'error': "Позиция с указанным id не найдена"})
+                elif op == 'update':
+                    fields, params = payload
+                    cursor.execute(f"UPDATE {INVENTORY_TABLE} SET {', '.join(fields)} WHERE id=?", tuple(params) + (item_id,))
+                    updated_ids.append((item_id,))
+                    results.append({'ok': True, 'id': item_id})
+                else:
+                    existing.discard(item_id)
+                    deleted_ids.append((item_id,))
+                    results.append({'ok': True, 'id': item_id})
+            if updated_ids:
+                cursor.executemany(BAR_EXPIRY_UPDATE_SQL, updated_ids)
+            if deleted_ids:
+                cursor.executemany(f"DELETE FROM {INVENTORY_TABLE} WHERE id=?", deleted_ids)
+            return results
+        return jsonify(ok=True, results=run_write(write))
+    except Exception as e:
+        return jsonify(ok=False, error=str(e))
+
+STATS_SQL = (
+    f"SELECT bar_id, category, SUM(total), SUM(opened), "
+    f"SUM(CASE WHEN expiry_day <= ? THEN total ELSE 0 END), "
+    f"SUM(CASE WHEN expiry_day > ? AND expiry_day <= ? THEN total ELSE 0 END) "
+    f"FROM {INVENTORY_STATS_TABLE} {{where}} GROUP BY bar_id, category"
+)
+
+def bar_stats(bar_id=None, days=None):
+    """Счётчики по барам и категориям: {bar_id: {'totals': {...}, 'categories': [...]}}.
+
+    Просроченные — как в /expired (срок не позже сегодня), истекающие — в
+    следующие days дней. Категории из CATEGORIES есть всегда, даже с нулями.
+    """
+    today = msk_today()
+    days = EXPIRY_NOTIFY_DAYS if days is None else days
+    where, params = ("WHERE bar_id=?", (bar_id,)) if bar_id is not None else ("", ())
+    rows = db_query(STATS_SQL.format(where=where), (today, today, today + days) + params, fetch=True)
+    def counters(total=0, opened=0, expired=0, expiring=0):
+        return {'total': total, 'opened': opened, 'sealed': total - opened, 'expired': expired, 'expiring': expiring}
+    result = {}
+    for row_bar_id, category, total, opened, expired, expiring in rows:
+        bar = result.setdefault(row_bar_id, {})
+        bar[category] = counters(total, opened, expired, expiring)
+    if bar_id is not None:
+        bar_ids = [bar_id]
+    else:
+        bar_ids = sorted({r[0] for r in db_query(f"SELECT bar_id FROM {BARS_TABLE}", fetch=True)} | set(result))
+    stats = {}
+    for row_bar_id in bar_ids:
+        by_category = result.get(row_bar_id, {})
+        categories = [dict(category=c, **by_category.get(c, counters())) for c in CATEGORIES]
+        categories += [dict(category=c, **v) for c, v in sorted(by_category.items()) if c not in CATEGORIES]
+        totals = counters()
+        for item in categories:
+            for field in ('total', 'opened', 'sealed', 'expired', 'expiring'):
+                totals[field] += item[field]
+        stats[row_bar_id] = {'totals': totals, 'categories': categories}
+    return stats
+
+@app.route('/stats', methods=['POST'])
+def api_stats():
+    """Сводка по бару пользователя; с all=true и ADMIN_TOKEN — по всей сети баров."""
+    data = request.get_json()
+    user_id = data.get('user_id')
+    try:
+        if not user_id or not check_user_access(user_id):
+            return jsonify(ok=False, error="Нет доступа")
+        days = int(data.get('days', EXPIRY_NOTIFY_DAYS))
+        if data.get('all'):
+            # user_id в теле запроса подделывается, поэтому сводка по сети — только по токену
+            if not has_bearer_token(ADMIN_TOKEN):
+                return jsonify(ok=False, error="Нет доступа")
+            bar_names = dict(db_query(f"SELECT bar_id, bar_name FROM {BARS_TABLE}", fetch=True))
+            bars = [
+                dict(bar_name=bar_names.get(bar_id), **bar) for bar_id, bar in bar_stats(days=days).items()
+            ]
+            totals = {field: sum(bar['totals'][field] for bar in bars) for field in bars[0]['totals']} if bars else {}
+            return jsonify(ok=True, days=days, bars=bars, totals=totals)
+        bar_id = get_user_bar_id(user_id)
+        stats = bar_stats(bar_id, days)[bar_id]
+        return jsonify(ok=True, days=days, bar_name=get_user_bar(user_id), **stats)
+    except Exception as e:
+        return jsonify(ok=False, error=str(e))
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     import traceback
     tb = ''.join(traceback.format_exception(None, context.error, context.error.__traceback__))
@@ -352,15 +1923,59 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         pass
 
+async def run_blocking(fn, *args, **kwargs):
+    """Выполняет синхронную работу с базой или файлами в bot_executor.
+
+    Обработчики бота работают в одном event loop: прямой вызов db_query
+    из них останавливает ответы всем остальным пользователям.
+    """
+    return await asyncio.get_running_loop().run_in_executor(bot_executor, functools.partial(fn, *args, **kwargs))
+
+def user_registration(user_id):
+    """(bar_name, registered_at) пользователя или None."""
+    res = db_query(f"SELECT bar_name, registered_at FROM {USERS_TABLE} WHERE user_id=?", (user_id,), fetch=True)
+    return res[0] if res else None
+
+def register_user(user_id, username, code):
+    """Регистрирует пользователя по коду приглашения.
+
+    Проверка кода, бара и погашение кода — в одной транзакции записи, поэтому
+    один код нельзя использовать дважды, а код на неизвестный бар не
+    регистрирует никого. Возвращает название бара, '' если пользователь уже
+    зарегистрирован, или None, если код не найден.
+    """
+    ensure_schema()
+    def write(cursor):
+        invite = cursor.execute(
+            f"SELECT bar_name FROM {INVITES_TABLE} WHERE code=? AND used='нет'", (code,)
+        ).fetchone()
+        if not invite:
+            return None
+        if cursor.execute(f"SELECT 1 FROM {USERS_TABLE} WHERE user_id=?", (user_id,)).fetchone():
+            return ''
+        bar_name = invite[0]
+        if not cursor.execute(f"SELECT 1 FROM {BARS_TABLE} WHERE bar_name=?", (bar_name,)).fetchone():
+            raise Exception(f"Неизвестный бар в приглашении: {bar_name}")
+        cursor.execute(
+            f"INSERT INTO {USERS_TABLE} (user_id, username, bar_name, registered_at) VALUES (?, ?, ?, ?)",
+            (user_id, username, bar_name, msk_now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        cursor.execute(f"UPDATE {INVITES_TABLE} SET used='да' WHERE code=?", (code,))
+        return bar_name
+    bar_name = run_write(write)
+    if bar_name:
+        invalidate_user_cache(user_id)
+    return bar_name
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        if not check_user_access(user_id):
+        if not await run_blocking(check_user_access, user_id):
             await update.message.reply_text("🔑 Введите ваш пригласительный код для регистрации:")
             return REG_WAIT_CODE
-        res = db_query(f"SELECT bar_name, registered_at FROM {USERS_TABLE} WHERE user_id=?", (user_id,), fetch=True)
+        res = await run_blocking(user_registration, user_id)
         if res:
-            bar, reg = res[0]
+            bar, reg = res
             await update.message.reply_text(
                 f"👤 Вы зарегистрированы в баре: <b>{bar}</b>\n"
                 f"Дата регистрации: {reg}", parse_mode="HTML"
@@ -376,28 +1991,13 @@ async def reg_wait_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or ""
     try:
-        invites = db_query(
-            f"SELECT bar_name FROM {INVITES_TABLE} WHERE code=? AND used='нет'", (code,), fetch=True
-        )
-        if not invites:
+        bar_name = await run_blocking(register_user, user_id, username, code)
+        if bar_name is None:
             await update.message.reply_text("❌ Код не найден или уже использован! Попробуйте снова или обратитесь к администратору.")
             return REG_WAIT_CODE
-        user_exists = db_query(
-            f"SELECT user_id FROM {USERS_TABLE} WHERE user_id=?", (user_id,), fetch=True
-        )
-        if user_exists:
+        if not bar_name:
             await update.message.reply_text("✅ Вы уже зарегистрированы.")
             return ConversationHandler.END
-        bar_name = invites[0][0]
-        now = msk_now().strftime('%Y-%m-%d %H:%M:%S')
-        db_query(
-            f"INSERT INTO {USERS_TABLE} (user_id, username, bar_name, registered_at) VALUES (?, ?, ?, ?)",
-            (user_id, username, bar_name, now)
-        )
-        db_query(
-            f"UPDATE {INVITES_TABLE} SET used='да' WHERE code=?", (code,)
-        )
-        ensure_bar_table(bar_name)
         await update.message.reply_text(f"✅ Добро пожаловать в {bar_name}!\nТеперь вы можете пользоваться мини-приложением (сайтом).")
         return ConversationHandler.END
     except Exception as e:
@@ -406,9 +2006,9 @@ async def reg_wait_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def whoami(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        res = db_query(f"SELECT bar_name, registered_at FROM {USERS_TABLE} WHERE user_id=?", (user_id,), fetch=True)
+        res = await run_blocking(user_registration, user_id)
         if res:
-            bar, reg = res[0]
+            bar, reg = res
             await update.message.reply_text(
                 f"👤 Вы зарегистрированы в баре: <b>{bar}</b>\n"
                 f"Дата регистрации: {reg}", parse_mode="HTML"
@@ -425,21 +2025,161 @@ async def lastbackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_only(update):
         await update.message.reply_text("Нет доступа")
         return
-    global last_backup_time
+    last_backup_time = await run_blocking(get_app_state, 'last_backup_time')
     if last_backup_time:
         await update.message.reply_text(f"Последний бэкап был: {last_backup_time}")
     else:
         await update.message.reply_text("Бэкап ещё не отправлялся.")
 
+class StatusMessage:
+    """Сообщение в чате, которое правится по ходу долгой операции.
+
+    progress() можно вызывать из рабочего потока: правка уходит в event loop
+    бота, поток её не ждёт. Правки применяются в порядке вызовов.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.text = message.text
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+
+    async def update(self, text):
+        async with self.lock:
+            if text == self.text:
+                return
+            try:
+                await self.message.edit_text(text)
+                self.text = text
+            except Exception as e:  # сообщение удалили, лимит правок и т.п. — операции это не мешает
+                print(f"[status] не удалось обновить сообщение: {e}")
+
+    def progress(self, text):
+        asyncio.run_coroutine_threadsafe(self.update(text), self.loop)
+
+def start_backup_task(update, context, job):
+    """Запускает job(status) фоном; второй бэкап, пока идёт первый, не запускается."""
+    if bot_runtime.backup_task is not None and not bot_runtime.backup_task.done():
+        return False
+    async def run():
+        status = StatusMessage(await update.message.reply_text("⏳ Бэкап запущен…"))
+        await job(status)
+    bot_runtime.backup_task = context.application.create_task(run())
+    return True
+
+BACKUP_RESULT_TEXT = {
+    'sent': "✅ Бэкап отправлен!",
+    'unchanged': "База не менялась с прошлого бэкапа.",
+    'too_large': "Сжатый снимок слишком большой для Telegram (>49MB)",
+    'missing': f"Файл базы не найден: {DB_FILENAME}",
+    'error': "❌ Ошибка при отправке бэкапа, подробности в логе",
+}
+
 async def forcebackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_only(update):
+        await update.message.reply_text("Нет доступа")
+        return
+    async def job(status):
+        # periodic_backup шлёт файл через этот же event loop, поэтому выполняется в потоке
+        result = await run_blocking(periodic_backup, force=True, progress=status.progress)
+        await status.update(BACKUP_RESULT_TEXT.get(result, BACKUP_RESULT_TEXT['error']))
+    if not start_backup_task(update, context, job):
+        await update.message.reply_text("Бэкап уже выполняется, дождитесь его завершения.")
+
+def metrics_summary(top=5):
+    """Короткая сводка для админа: самые медленные эндпоинты и SQL по суммарному времени."""
+    with _metrics_lock:
+        histograms = {key: list(hist) for key, hist in _histograms.items()}
+        opened = sum(v for (name, _), v in _counters.items() if name == 'db_connections_opened_total')
+        backups = {dict(labels).get('result'): v for (name, labels), v in _counters.items() if name == 'backups_total'}
+    endpoints = {}
+    for (name, labels), hist in histograms.items():
+        if name == 'http_request_duration_seconds':
+            endpoint = dict(labels)['endpoint']
+            merged = endpoints.setdefault(endpoint, [0] * len(hist[:-1]) + [hist[-1]])
+            for i, v in enumerate(hist[:-1]):
+                merged[i] += v
+    lines = [f"Метрики воркера {os.getpid()}", "", "Эндпоинты (запросов, среднее, p95):"]
+    for endpoint, hist in sorted(endpoints.items(), key=lambda kv: -kv[1][-3])[:top]:
+        lines.append(
+            f"{endpoint}: {hist[-2]}, {hist[-3] / hist[-2] * 1000:.1f} мс, ≤{histogram_quantile(hist, 0.95) * 1000:g} мс"
+        )
+    queries = sorted(
+        ((dict(labels)['query'], hist) for (name, labels), hist in histograms.items() if name == 'db_query_duration_seconds'),
+        key=lambda kv: -kv[1][-3]
+    )[:top]
+    lines += ["", "SQL по суммарному времени:"]
+    for query, hist in queries:
+        lines.append(f"{hist[-3] * 1000:.0f} мс / {hist[-2]} — {query[:120]}")
+    lines += ["", f"Открыто соединений: {opened}", f"Бэкапы: {backups or 'ещё не было'}"]
+    return "\n".join(lines)
+
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_only(update):
+        await update.message.reply_text("Нет доступа")
+        return
+    await update.message.reply_text(metrics_summary())
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_only(update):
+        await update.message.reply_text("Нет доступа")
+        return
+    try:
+        bar_names = dict(await run_blocking(db_query, f"SELECT bar_id, bar_name FROM {BARS_TABLE}", fetch=True))
+        by_bar = await run_blocking(bar_stats)
+        lines = [f"Позиции по барам (всего / открыто / просрочено / истекает за {EXPIRY_NOTIFY_DAYS} дн.):"]
+        for bar_id, bar in by_bar.items():
+            t = bar['totals']
+            lines.append(f"{bar_names.get(bar_id)}: {t['total']} / {t['opened']} / {t['expired']} / {t['expiring']}")
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+
+async def notifyexpiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_only(update):
+        await update.message.reply_text("Нет доступа")
+        return
+    try:
+        sent_bars = await run_blocking(notify_expiring, force=True)
+        await update.message.reply_text(f"Сводка по срокам разослана барам: {sent_bars or 0}")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка при рассылке: {e}")
+
+async def archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await admin_only(update):
         await update.message.reply_text("Нет доступа")
         return
     try:
-        periodic_backup()
-        await update.message.reply_text("Бэкап отправлен!")
+        moved = await run_blocking(archive_inventory)
+        if moved is None:
+            await update.message.reply_text("Ошибка при архивации, подробности в логе")
+            return
+        await update.message.reply_text(
+            f"Перенесено в архив: закрытых {moved['closed']}, просроченных {moved['expired']}"
+        )
     except Exception as e:
-        await update.message.reply_text(f"Ошибка при отправке бэкапа: {e}")
+        await update.message.reply_text(f"Ошибка при архивации: {e}")
+
+async def addbar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await admin_only(update):
+        await update.message.reply_text("Нет доступа")
+        return
+    bar_name = (context.args[0] if context.args else "").strip()
+    if not bar_name or not bar_name.isalnum():
+        await update.message.reply_text("Использование: /addbar НАЗВАНИЕ (только буквы и цифры)")
+        return
+    def register_bar():
+        ensure_schema()
+        db_query(
+            f"INSERT OR IGNORE INTO {BARS_TABLE} (bar_name, created_at) VALUES (?, ?)",
+            (bar_name, msk_now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        return get_bar_id(bar_name)
+    try:
+        bar_id = await run_blocking(register_bar)
+        await update.message.reply_text(f"✅ Бар {bar_name} в реестре (id {bar_id}).")
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка при добавлении бара: {e}")
 
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -452,6 +2192,11 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             '/forcebackup — сделать бэкап сейчас (админ)',
             '/sendbackup — получить текущий бэкап базы (админ)',
             '/restorebackup — восстановить базу из файла (админ)',
+            '/addbar — добавить бар в реестр (админ)',
+            '/notifyexpiry — разослать сводку по срокам сейчас (админ)',
+            '/metrics — задержки API и медленные запросы к базе (админ)',
+            '/stats — позиции и сроки по всем барам (админ)',
+            '/archive — перенести закрытые и просроченные позиции в архив (админ)',
             '/uploadbackup — переслать файл в чат (админ)',
             '/info — список команд',
         ]
@@ -464,73 +2209,554 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = 'Доступные команды:\n' + '\n'.join(commands)
     await update.message.reply_text(text)
 
-# изменяем periodic_backup чтобы сохранять время
-def periodic_backup():
-    global last_backup_time
+# --- Бэкапы ---
+BACKUP_MAX_BYTES = 49 * 1024 * 1024  # лимит Telegram на документ от бота
+BACKUP_INTERVAL_MINUTES = int(os.getenv("BACKUP_INTERVAL_MINUTES", 15))
+BACKUP_SUFFIXES = ('.sqlite', '.sqlite.gz')
+
+# подпись бэкапа: "sha256:<хэш содержимого> seq:<последний seq журнала в снимке>",
+# по ней при запуске решается, новее ли бэкап локальной базы
+BACKUP_CAPTION_PREFIX = "sha256:"
+BACKUP_CAPTION_SEQ = "seq:"
+
+def backup_caption(digest, journal_seq):
+    return f"{BACKUP_CAPTION_PREFIX}{digest} {BACKUP_CAPTION_SEQ}{journal_seq}"
+
+def parse_backup_caption(caption):
+    """(хэш, seq журнала) из подписи; чего нет (старые бэкапы, ручная загрузка) — None."""
+    digest = journal_seq = None
+    for part in (caption or "").split():
+        if part.startswith(BACKUP_CAPTION_PREFIX):
+            digest = part[len(BACKUP_CAPTION_PREFIX):]
+        elif part.startswith(BACKUP_CAPTION_SEQ) and part[len(BACKUP_CAPTION_SEQ):].isdigit():
+            journal_seq = int(part[len(BACKUP_CAPTION_SEQ):])
+    return digest, journal_seq
+
+def is_backup_filename(file_name):
+    return bool(file_name) and file_name.endswith(BACKUP_SUFFIXES)
+
+# служебные ключи бэкапа: меняются при каждой отправке и не должны влиять на хеш
+BACKUP_STATE_KEYS = ('last_backup_hash', 'last_backup_time', 'journal_flushed_seq')
+
+def backup_content_digest(conn):
+    """sha256 содержимого снимка без служебных данных бэкапа.
+
+    Хешируются строки всех таблиц, кроме журнала изменений, служебных ключей
+    app_state и теневых таблиц FTS (они производны от inventory). Поэтому
+    запись last_backup_hash после отправки не меняет хеш следующего снимка.
+    """
+    digest = hashlib.sha256()
+    tables = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    ).fetchall()
+    virtual = [name for name, sql in tables if sql and sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    for name, sql in tables:
+        if name == CHANGE_LOG_TABLE or any(name == v or name.startswith(v + '_') for v in virtual):
+            continue
+        columns = [r[1] for r in conn.execute(f"PRAGMA table_info({name})")]
+        order = ", ".join(columns)
+        query = f"SELECT * FROM {name}"
+        params = ()
+        if name == APP_STATE_TABLE:
+            query += f" WHERE key NOT IN ({', '.join('?' * len(BACKUP_STATE_KEYS))})"
+            params = BACKUP_STATE_KEYS
+        digest.update(f"{name}:{order}\n".encode())
+        for row in conn.execute(f"{query} ORDER BY {order}", params):
+            digest.update(repr(row).encode())
+            digest.update(b"\n")
+    return digest.hexdigest()
+
+def make_backup_snapshot(progress=None):
+    """Консистентный снимок базы через backup API, сжатый gzip.
+
+    Снимок читается в одной транзакции чтения, поэтому параллельная запись
+    из Flask не блокируется и не попадает в файл наполовину.
+    Возвращает (путь к .gz, хеш содержимого снимка без служебных данных бэкапа
+    — см. backup_content_digest, размер несжатого снимка,
+    последний seq журнала изменений, вошедший в снимок). progress(text),
+    если передан, получает этапы и процент сжатия.
+    """
+    report = progress or (lambda text: None)
+    fd, snapshot_path = tempfile.mkstemp(prefix="backup-", suffix=".sqlite")
+    os.close(fd)
+    try:
+        report("⏳ Снимок базы…")
+        dst = sqlite3.connect(snapshot_path)
+        try:
+            get_db().backup(dst)
+            journal_seq = last_journal_seq(dst.cursor())
+            report("⏳ Хеш содержимого…")
+            digest = backup_content_digest(dst)
+        finally:
+            dst.close()
+        gz_path = snapshot_path + ".gz"
+        raw_size = os.path.getsize(snapshot_path)
+        done, next_report = 0, 0
+        with open(snapshot_path, "rb") as src, open(gz_path, "wb") as raw_out:
+            # mtime=0 — одинаковая база даёт побайтно одинаковый архив
+            with gzip.GzipFile(filename=os.path.basename(DB_FILENAME), mode="wb", fileobj=raw_out, mtime=0) as out:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    # прогресс не чаще чем через 25%: у Telegram лимит на правки сообщений
+                    if done >= next_report:
+                        report(f"⏳ Сжатие снимка: {done * 100 // raw_size}%")
+                        next_report += raw_size // 4
+                    out.write(chunk)
+                    done += len(chunk)
+        return gz_path, digest, raw_size, journal_seq
+    finally:
+        os.remove(snapshot_path)
+
+def backup_document_name():
+    return os.path.basename(DB_FILENAME) + ".gz"
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def install_backup_file(path, file_name, journal_seq=None):
+    """Ставит скачанный бэкап (.sqlite или .sqlite.gz) на место текущей базы.
+
+    С journal_seq файл подменяется под блокировкой записи и только если seq
+    журнала не изменился: запись, прошедшая, пока бэкап скачивался, не
+    затирается — восстановление отменяется.
+    """
+    if file_name.endswith('.gz'):
+        raw_path = path + ".raw"
+        with gzip.open(path, "rb") as src, open(raw_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        path = raw_path
+    with open(path, "rb") as f:
+        if f.read(16) != b"SQLite format 3\x00":
+            os.remove(path)
+            raise Exception("Файл не похож на базу SQLite")
+    if journal_seq is None:
+        replace_db_file(path)
+        return
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if last_journal_seq(conn.cursor()) != journal_seq:
+            raise Exception("В базу записали, пока скачивался бэкап — восстановление отменено")
+        # замок записи держим до подмены: replace_db_file закрывает и это соединение
+        replace_db_file(path)
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+def send_admin_document(path, filename, disable_notification=False, caption=None):
+    """Отправляет файл админу из рабочего потока (планировщик, executor).
+
+    Если бот запущен, используется его Bot в общем event loop; отдельный
+    Application поднимается только вне основного процесса (скрипты, тесты).
+    """
+    async def send(bot):
+        with open(path, "rb") as f:
+            await bot.send_document(
+                chat_id=TELEGRAM_ADMIN_ID, document=f, filename=filename,
+                disable_notification=disable_notification, caption=caption
+            )
+    run_bot_call(send)
+
+def run_bot_call(send):
+    """Выполняет корутину send(bot) из рабочего потока и возвращает её результат."""
+    if bot_runtime.loop is not None:
+        return asyncio.run_coroutine_threadsafe(send(bot_runtime.bot), bot_runtime.loop).result()
+    async def send_standalone():
+        async with Bot(token=BOT_TOKEN) as bot:
+            return await send(bot)
+    return asyncio.run(send_standalone())
+
+_backup_lock = threading.Lock()
+
+def periodic_backup(force=False, progress=None):
+    """Снимок базы админу в Telegram. Возвращает результат: sent, unchanged,
+    too_large, missing или error (как метка backups_total).
+
+    Бэкапы по расписанию и из чата не идут одновременно — второй ждёт первый.
+    """
+    with _backup_lock:
+        return _periodic_backup(force, progress)
+
+def _periodic_backup(force, progress):
+    started = time.perf_counter()
     try:
         if not os.path.exists(DB_FILENAME):
             print(f"[periodic_backup] Файл базы не найден: {DB_FILENAME}")
-            return
-        file_size = os.path.getsize(DB_FILENAME)
-        print(f"[periodic_backup] Размер файла: {file_size} байт")
-        if file_size > 49 * 1024 * 1024:
-            print(f"[periodic_backup] Файл слишком большой для Telegram (>49MB)")
-            return
-        # Используем асинхронную отправку через telegram.ext
-        from telegram.ext import Application
-        import asyncio
-        async def send_backup():
-            app = Application.builder().token(BOT_TOKEN).build()
-            async with app:
-                with open(DB_FILENAME, "rb") as f:
-                    await app.bot.send_document(chat_id=TELEGRAM_ADMIN_ID, document=f, filename=DB_FILENAME)
+            return 'missing'
+        ensure_schema()
+        gz_path, digest, raw_size, journal_seq = make_backup_snapshot(progress)
+        try:
+            if not force and digest == get_app_state('last_backup_hash'):
+                print("[periodic_backup] База не менялась с прошлого бэкапа, пропускаю отправку")
+                metric_inc('backups_total', {'result': 'unchanged'})
+                return 'unchanged'
+            file_size = os.path.getsize(gz_path)
+            print(f"[periodic_backup] Размер снимка: {raw_size} байт, сжатый: {file_size} байт")
+            metric_set('backup_last_size_bytes', raw_size, {'kind': 'raw'})
+            metric_set('backup_last_size_bytes', file_size, {'kind': 'gzip'})
+            if file_size > BACKUP_MAX_BYTES:
+                print(f"[periodic_backup] Сжатый снимок слишком большой для Telegram (>49MB)")
+                metric_inc('backups_total', {'result': 'too_large'})
+                return 'too_large'
+            if progress:
+                progress(f"⏳ Отправка снимка: {file_size} байт…")
+            send_admin_document(gz_path, backup_document_name(), caption=backup_caption(digest, journal_seq))
             print("Бэкап базы отправлен в Telegram.")
-        asyncio.run(send_backup())
-        last_backup_time = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
+        finally:
+            os.remove(gz_path)
+        metric_inc('backups_total', {'result': 'sent'})
+        metric_observe('backup_duration_seconds', time.perf_counter() - started)
+        metric_set('backup_last_success_timestamp_seconds', time.time())
+        set_app_state('last_backup_hash', digest)
+        # всё, что попало в полный снимок, из журнала больше не нужно
+        db_query(f"DELETE FROM {CHANGE_LOG_TABLE} WHERE seq <= ?", (journal_seq,))
+        if journal_seq > int(get_app_state('journal_flushed_seq', 0)):
+            set_app_state('journal_flushed_seq', journal_seq)
+        set_app_state('last_backup_time', datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S'))
+        return 'sent'
     except Exception as e:
+        metric_inc('backups_total', {'result': 'error'})
         print(f"Ошибка при отправке бэкапа: {e}")
+        return 'error'
+
+JOURNAL_FLUSH_SECONDS = int(os.getenv("JOURNAL_FLUSH_SECONDS", 30))
+JOURNAL_FLUSH_MAX_ROWS = 50000
+
+def flush_change_journal():
+    """Отправляет новые записи журнала изменений сжатым NDJSON-файлом (дельтой)."""
+    try:
+        ensure_schema()
+        flushed_seq = int(get_app_state('journal_flushed_seq', 0))
+        rows = db_query(
+            f"SELECT seq, tbl, op, row_id, data, ts FROM {CHANGE_LOG_TABLE} WHERE seq > ? ORDER BY seq LIMIT ?",
+            (flushed_seq, JOURNAL_FLUSH_MAX_ROWS), fetch=True
+        )
+        if not rows:
+            return
+        fd, delta_path = tempfile.mkstemp(prefix="journal-", suffix=".ndjson.gz")
+        os.close(fd)
+        try:
+            with gzip.open(delta_path, "wt", encoding="utf-8") as out:
+                for seq, tbl, op, row_id, data, ts in rows:
+                    out.write(json.dumps({
+                        'seq': seq, 'tbl': tbl, 'op': op, 'row_id': row_id,
+                        'data': json.loads(data) if data else None, 'ts': ts
+                    }, ensure_ascii=False) + "\n")
+            send_admin_document(
+                delta_path, f"journal-{rows[0][0]}-{rows[-1][0]}.ndjson.gz", disable_notification=True
+            )
+        finally:
+            os.remove(delta_path)
+        set_app_state('journal_flushed_seq', rows[-1][0])
+        print(f"[journal] Отправлена дельта: {len(rows)} изменений (seq {rows[0][0]}–{rows[-1][0]})")
+    except Exception as e:
+        print(f"Ошибка при отправке журнала изменений: {e}")
+
+def replay_change_journal(base_path, delta_paths, out_path):
+    """Собирает базу из полного снимка и дельт журнала.
+
+    Применяются только записи с seq больше последнего seq в снимке, поэтому
+    лишние или повторяющиеся дельты безопасны. Возвращает число применённых изменений.
+    """
+    opener = gzip.open if base_path.endswith('.gz') else open
+    with opener(base_path, "rb") as src, open(out_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    entries = {}
+    for path in delta_paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry['seq']] = entry
+    conn = sqlite3.connect(out_path, isolation_level=None)
+    applied = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        ensure_change_journal(cursor)
+        start_seq = last_journal_seq(cursor)
+        # на время применения журнальные триггеры не нужны: записи переносим как есть
+        for (name,) in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'journal\\_%' ESCAPE '\\'"
+        ).fetchall():
+            cursor.execute(f"DROP TRIGGER {name}")
+        for seq in sorted(entries):
+            if seq <= start_seq:
+                continue
+            entry = entries[seq]
+            table = entry['tbl']
+            if table not in JOURNAL_TABLES:
+                raise Exception(f"Неизвестная таблица в журнале: {table}")
+            if entry['op'] == 'delete':
+                cursor.execute(f"DELETE FROM {table} WHERE rowid=?", (entry['row_id'],))
+            else:
+                data = entry['data']
+                columns = list(data)
+                cursor.execute(
+                    f"UPDATE {table} SET {', '.join(f'{c}=?' for c in columns)} WHERE rowid=?",
+                    [data[c] for c in columns] + [entry['row_id']]
+                )
+                if cursor.rowcount == 0:
+                    cursor.execute(
+                        f"INSERT INTO {table} (rowid, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+                        [entry['row_id']] + [data[c] for c in columns]
+                    )
+            cursor.execute(
+                f"INSERT INTO {CHANGE_LOG_TABLE} (seq, tbl, op, row_id, data, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (seq, table, entry['op'], entry['row_id'],
+                 json.dumps(entry['data'], ensure_ascii=False) if entry['data'] is not None else None, entry['ts'])
+            )
+            applied += 1
+        ensure_change_journal(cursor)
+        cursor.execute("COMMIT")
+    finally:
+        conn.close()
+    return applied
+
+# --- Уведомления о сроках годности ---
+EXPIRY_NOTIFY_DAYS = int(os.getenv("EXPIRY_NOTIFY_DAYS", 3))
+EXPIRY_NOTIFY_HOUR = int(os.getenv("EXPIRY_NOTIFY_HOUR", 10))  # по Москве
+EXPIRY_NOTIFY_MAX_LINES = 15  # позиций на группу в одном сообщении
+EXPIRY_GROUPS = (
+    ('expired', '❌ Просрочено'),
+    ('today', '⚠️ Истекает сегодня'),
+    ('tomorrow', '⏳ Истекает завтра'),
+    ('soon', '📅 В ближайшие дни'),
+)
+
+def compute_expiry_digest(bar_id, day):
+    """Позиции бара со сроком до day + EXPIRY_NOTIFY_DAYS, разложенные по группам."""
+    today = parse_day(day)
+    groups = {key: [] for key, _ in EXPIRY_GROUPS}
+    rows = db_query(
+        f"SELECT id, name, tob, expiry_final FROM {INVENTORY_TABLE} INDEXED BY idx_inventory_bar_expiry "
+        f"WHERE bar_id=? AND expiry_final IS NOT NULL AND expiry_final <= ? ORDER BY expiry_final, id",
+        (bar_id, today + EXPIRY_NOTIFY_DAYS), fetch=True
+    )
+    for item_id, name, tob, expiry in rows:
+        key = 'expired' if expiry < today else 'today' if expiry == today else 'tomorrow' if expiry == today + 1 else 'soon'
+        groups[key].append({"id": item_id, "name": name, "tob": tob, "expiry_final": format_day(expiry)})
+    return groups
+
+def format_expiry_digest(bar_name, day, groups):
+    lines = [f"Сроки годности — {bar_name}, {day}"]
+    for key, title in EXPIRY_GROUPS:
+        items = groups.get(key) or []
+        if not items:
+            continue
+        lines.append(f"\n{title}: {len(items)}")
+        for item in items[:EXPIRY_NOTIFY_MAX_LINES]:
+            lines.append(f"• {item['name']} (ТОБ {item['tob']}) — до {item['expiry_final']}")
+        if len(items) > EXPIRY_NOTIFY_MAX_LINES:
+            lines.append(f"…и ещё {len(items) - EXPIRY_NOTIFY_MAX_LINES}")
+    return "\n".join(lines)
+
+def notify_expiring(force=False):
+    """Раз в день: сводка по срокам для каждого бара и одно сообщение его пользователям.
+
+    Сводка сохраняется в expiry_digest; бар, которому сегодня уже отправили,
+    пропускается (повторный запуск после рестарта не дублирует сообщения).
+    """
+    try:
+        ensure_schema()
+        day = msk_today_str()
+        now = msk_now().strftime('%Y-%m-%d %H:%M:%S')
+        sent_bars = 0
+        for bar_id, bar_name in db_query(f"SELECT bar_id, bar_name FROM {BARS_TABLE} ORDER BY bar_id", fetch=True):
+            sent = db_query(
+                f"SELECT sent_at FROM {EXPIRY_DIGEST_TABLE} WHERE bar_id=? AND day=?", (bar_id, day), fetch=True
+            )
+            if sent and sent[0][0] and not force:
+                continue
+            groups = compute_expiry_digest(bar_id, day)
+            db_query(
+                f"INSERT INTO {EXPIRY_DIGEST_TABLE} (bar_id, day, items, computed_at) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT(bar_id, day) DO UPDATE SET items=excluded.items, computed_at=excluded.computed_at",
+                (bar_id, day, json.dumps(groups, ensure_ascii=False), now)
+            )
+            if not any(groups.values()):
+                continue
+            user_ids = [r[0] for r in db_query(
+                f"SELECT user_id FROM {USERS_TABLE} WHERE bar_name=?", (bar_name,), fetch=True
+            )]
+            if not user_ids:
+                continue
+            text = format_expiry_digest(bar_name, day, groups)
+
+            async def send(bot):
+                delivered = 0
+                for user_id in user_ids:
+                    try:
+                        await bot.send_message(chat_id=int(user_id), text=text)
+                        delivered += 1
+                    except Exception as e:  # пользователь мог заблокировать бота
+                        print(f"[notify_expiring] {bar_name}: не доставлено {user_id}: {e}")
+                return delivered
+
+            delivered = run_bot_call(send)
+            db_query(
+                f"UPDATE {EXPIRY_DIGEST_TABLE} SET sent_at=? WHERE bar_id=? AND day=?", (now, bar_id, day)
+            )
+            sent_bars += 1
+            print(f"[notify_expiring] {bar_name}: сводка отправлена {delivered}/{len(user_ids)}")
+        return sent_bars
+    except Exception as e:
+        print(f"Ошибка при рассылке сроков: {e}")
+
+# --- Архив: перенос закрытых и просроченных позиций, сжатие файла ---
+ARCHIVE_CLOSED_AFTER_DAYS = int(os.getenv("ARCHIVE_CLOSED_AFTER_DAYS", 1))
+ARCHIVE_EXPIRED_AFTER_DAYS = int(os.getenv("ARCHIVE_EXPIRED_AFTER_DAYS", 30))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 500))
+ARCHIVE_HOUR = int(os.getenv("ARCHIVE_HOUR", 4))  # по Москве
+ARCHIVE_COLUMNS = (
+    "id, bar_id, category, tob, name, manufactured_at, shelf_life_days, opened_at, "
+    "opened_shelf_life_days, opened, expiry_at, expiry_final"
+)
+# причина -> условие; closed — бутылка вскрыта и уже заменена или закрыта (opened=0 при opened_at)
+ARCHIVE_RULES = (
+    ('closed', "opened = 0 AND opened_at IS NOT NULL AND opened_at <= ?"),
+    ('expired', "expiry_final IS NOT NULL AND expiry_final <= ?"),
+)
+
+def archive_inventory():
+    """Переносит закрытые и давно просроченные позиции из inventory в архив.
+
+    Работает пачками по ARCHIVE_BATCH_SIZE, каждая — отдельная короткая
+    транзакция через run_write, и идёт по id, поэтому таблица просматривается
+    один раз за правило. Удаление из inventory срабатывает на обычных
+    триггерах: поиск, агрегаты /stats, версии баров и журнал остаются
+    согласованными. После переноса файл сжимается (compact_db).
+    """
+    try:
+        ensure_schema()
+        today = msk_today()
+        cutoffs = {'closed': today - ARCHIVE_CLOSED_AFTER_DAYS, 'expired': today - ARCHIVE_EXPIRED_AFTER_DAYS}
+        now = msk_now().strftime('%Y-%m-%d %H:%M:%S')
+        moved = {}
+        for reason, condition in ARCHIVE_RULES:
+            moved[reason] = 0
+            last_id = 0
+            while True:
+                def write(cursor):
+                    ids = [r[0] for r in cursor.execute(
+                        f"SELECT id FROM {INVENTORY_TABLE} WHERE id > ? AND {condition} ORDER BY id LIMIT ?",
+                        (last_id, cutoffs[reason], ARCHIVE_BATCH_SIZE)
+                    )]
+                    if ids:
+                        placeholders = ", ".join("?" * len(ids))
+                        cursor.execute(
+                            f"INSERT INTO {ARCHIVE_TABLE} ({ARCHIVE_COLUMNS}, archived_at, reason) "
+                            f"SELECT {ARCHIVE_COLUMNS}, ?, ? FROM {INVENTORY_TABLE} WHERE id IN ({placeholders})",
+                            [now, reason] + ids
+                        )
+                        cursor.execute(f"DELETE FROM {INVENTORY_TABLE} WHERE id IN ({placeholders})", ids)
+                    return ids
+                ids = run_write(write)
+                moved[reason] += len(ids)
+                if len(ids) < ARCHIVE_BATCH_SIZE:
+                    break
+                last_id = ids[-1]
+            metric_inc('archived_rows_total', {'reason': reason}, moved[reason])
+        freed = compact_db()
+        print(f"[archive] перенесено в архив: {moved}, освобождено страниц: {freed}")
+        return moved
+    except Exception as e:
+        print(f"Ошибка при архивации: {e}")
+
+def compact_db():
+    """Возвращает файлу страницы, освободившиеся после архивации.
+
+    Первый вызов переводит базу в auto_vacuum=INCREMENTAL — это требует одного
+    полного VACUUM; дальше хватает PRAGMA incremental_vacuum, который
+    отдаёт только свободные страницы и не переписывает файл целиком.
+    Возвращает число освобождённых страниц.
+    """
+    conn = get_db()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free_pages:
+        # execute делает один шаг — одну страницу; executescript выполняет прагму до конца
+        conn.executescript("PRAGMA incremental_vacuum")
+    return free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
 
 def start_periodic_backup():
     scheduler = BackgroundScheduler()
-    scheduler.add_job(periodic_backup, 'interval', hours=2, minutes=30)
+    scheduler.add_job(periodic_backup, 'interval', minutes=BACKUP_INTERVAL_MINUTES)
+    scheduler.add_job(flush_change_journal, 'interval', seconds=JOURNAL_FLUSH_SECONDS, max_instances=1, coalesce=True)
+    scheduler.add_job(
+        notify_expiring, 'cron', hour=EXPIRY_NOTIFY_HOUR, timezone=MSK_TZ,
+        misfire_grace_time=6 * 3600, coalesce=True
+    )
+    scheduler.add_job(
+        archive_inventory, 'cron', hour=ARCHIVE_HOUR, timezone=MSK_TZ,
+        misfire_grace_time=6 * 3600, coalesce=True, max_instances=1
+    )
     scheduler.start()
+    bot_runtime.scheduler = scheduler
 
-def restore_db_from_telegram():
-    try:
-        bot = Bot(token=BOT_TOKEN)
-        updates = bot.get_updates()
-        bot_id = bot.get_me().id
-        found = False
-        # Сначала ищем среди сообщений от самого бота
-        for update in reversed(updates):
-            msg = update.message
-            if msg and msg.from_user and msg.from_user.id == bot_id:
-                if msg.document and msg.document.file_name.endswith('.sqlite'):
-                    file = bot.get_file(msg.document.file_id)
-                    file.download(DB_FILENAME)
-                    print("База данных восстановлена из Telegram (отправитель: бот).")
-                    found = True
-                    break
-        # Если не найдено — ищем среди сообщений от админа
-        if not found:
-            for update in reversed(updates):
-                msg = update.message
-                if msg and msg.from_user and msg.from_user.id == TELEGRAM_ADMIN_ID:
-                    if msg.document and msg.document.file_name.endswith('.sqlite'):
-                        file = bot.get_file(msg.document.file_id)
-                        file.download(DB_FILENAME)
-                        print("База данных восстановлена из Telegram (отправитель: админ).")
-                        found = True
-                        break
+async def find_latest_backup(bot):
+    """Последний бэкап в чате: (document, хэш и seq журнала из подписи, отправитель) или None.
+
+    Сообщения от самого бота важнее сообщений админа — один проход по updates.
+    """
+    updates = await bot.get_updates()
+    candidates = {}
+    for update in reversed(updates):
+        msg = update.message
+        if not (msg and msg.from_user and msg.document and is_backup_filename(msg.document.file_name)):
+            continue
+        sender = 'бот' if msg.from_user.id == bot.id else 'админ' if msg.from_user.id == TELEGRAM_ADMIN_ID else None
+        if sender and sender not in candidates:
+            digest, journal_seq = parse_backup_caption(msg.caption)
+            candidates[sender] = (msg.document, digest, journal_seq, sender)
+        if 'бот' in candidates:
+            break
+    return candidates.get('бот') or candidates.get('админ')
+
+async def restore_db_from_telegram(bot, journal_seq=None):
+    """Скачивает последний бэкап из Telegram, если локальная база устарела.
+
+    journal_seq — seq журнала локальной базы на момент запуска; None —
+    локальной базы нет, бэкап ставится безусловно. Решение принимается по
+    содержимому, а не по mtime файла (после деплоя он всегда свежий): бэкап
+    не ставится, если его хэш совпадает с последним отправленным отсюда или
+    если в локальной базе есть записи журнала позже снимка. База без отметки
+    о бэкапе (например, из репозитория) восстанавливается всегда — но не
+    если в неё уже записали после запуска (см. install_backup_file).
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        found = await find_latest_backup(bot)
         if not found:
             print("Файл базы не найден в чате Telegram. Используется локальная база (если есть).")
+            return
+        document, digest, backup_seq, sender = found
+        if journal_seq is not None:
+            local_hash = await loop.run_in_executor(db_executor, get_app_state, 'last_backup_hash')
+            if local_hash is not None and digest == local_hash:
+                print("[restore] Хэш последнего бэкапа совпадает с локальной базой, восстановление не нужно.")
+                return
+            if local_hash is not None and backup_seq is not None and journal_seq > backup_seq:
+                print(f"[restore] В локальной базе есть изменения новее бэкапа (журнал {journal_seq} > {backup_seq}), восстановление не нужно.")
+                return
+        file = await bot.get_file(document.file_id)
+        await file.download_to_drive(DB_FILENAME + ".restore")
+        await loop.run_in_executor(
+            db_executor, install_backup_file, DB_FILENAME + ".restore", document.file_name, journal_seq
+        )
+        if digest:
+            # база совпадает с бэкапом: следующий запуск и бэкап по расписанию это увидят
+            await loop.run_in_executor(db_executor, lambda: (ensure_schema(), set_app_state('last_backup_hash', digest)))
+        print(f"База данных восстановлена из Telegram (отправитель: {sender}).")
     except Exception as e:
         print(f"Ошибка при восстановлении базы: {e}")
 
-def run_flask():
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
-
 UPLOAD_BACKUP_WAIT_FILE = 100  # новое состояние для загрузки бэкапа
 
 async def uploadbackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -547,18 +2773,17 @@ async def handle_backup_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Нет доступа")
         return ConversationHandler.END
     doc = update.message.document
-    if not doc or not doc.file_name.endswith('.sqlite'):
-        await update.message.reply_text("Пожалуйста, отправьте файл с расширением .sqlite")
+    if not doc or not is_backup_filename(doc.file_name):
+        await update.message.reply_text("Пожалуйста, отправьте файл с расширением .sqlite или .sqlite.gz")
         return UPLOAD_BACKUP_WAIT_FILE
     file = await doc.get_file()
     file_path = f"received_{doc.file_name}"
     await file.download_to_drive(file_path)
     await update.message.reply_text(f"Файл получен. Отправляю в чат...")
-    bot = Bot(token=BOT_TOKEN)
-    with open(file_path, "rb") as f:
-        bot.send_document(chat_id=TELEGRAM_ADMIN_ID, document=f, filename=doc.file_name)
+    document = await run_blocking(read_file, file_path)
+    await context.bot.send_document(chat_id=TELEGRAM_ADMIN_ID, document=document, filename=doc.file_name)
     await update.message.reply_text("Бэкап отправлен!")
-    os.remove(file_path)
+    await run_blocking(os.remove, file_path)
     return ConversationHandler.END
 
 async def sendbackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -566,27 +2791,38 @@ async def sendbackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != TELEGRAM_ADMIN_ID:
         await update.message.reply_text("Нет доступа")
         return
-    try:
-        if not os.path.exists(DB_FILENAME):
-            await update.message.reply_text(f"Файл базы не найден: {DB_FILENAME}")
-            return
-        file_size = os.path.getsize(DB_FILENAME)
-        await update.message.reply_text(f"Размер файла: {file_size} байт. Пробую отправить...")
-        if file_size > 49 * 1024 * 1024:
-            await update.message.reply_text("Файл слишком большой для Telegram (>49MB)")
-            return
-        with open(DB_FILENAME, "rb") as f:
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=f, filename=DB_FILENAME)
-        await update.message.reply_text("Бэкап отправлен!")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка при отправке бэкапа: {e}")
+    chat_id = update.effective_chat.id
+    async def job(status):
+        try:
+            if not os.path.exists(DB_FILENAME):
+                await status.update(BACKUP_RESULT_TEXT['missing'])
+                return
+            gz_path, digest, raw_size, journal_seq = await run_blocking(make_backup_snapshot, progress=status.progress)
+            try:
+                file_size = os.path.getsize(gz_path)
+                if file_size > BACKUP_MAX_BYTES:
+                    await status.update(BACKUP_RESULT_TEXT['too_large'])
+                    return
+                await status.update(f"⏳ Размер базы: {raw_size} байт, сжатый снимок: {file_size} байт. Отправляю…")
+                document = await run_blocking(read_file, gz_path)
+                await context.bot.send_document(
+                    chat_id=chat_id, document=document, filename=backup_document_name(),
+                    caption=backup_caption(digest, journal_seq)
+                )
+            finally:
+                os.remove(gz_path)
+            await status.update(BACKUP_RESULT_TEXT['sent'])
+        except Exception as e:
+            await status.update(f"❌ Ошибка при отправке бэкапа: {e}")
+    if not start_backup_task(update, context, job):
+        await update.message.reply_text("Бэкап уже выполняется, дождитесь его завершения.")
 
 async def restorebackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != TELEGRAM_ADMIN_ID:
         await update.message.reply_text("Нет доступа")
         return ConversationHandler.END
-    await update.message.reply_text("Пожалуйста, отправьте файл бэкапа (.sqlite), чтобы восстановить базу. ВНИМАНИЕ: текущая база будет перезаписана!")
+    await update.message.reply_text("Пожалуйста, отправьте файл бэкапа (.sqlite или .sqlite.gz), чтобы восстановить базу. ВНИМАНИЕ: текущая база будет перезаписана!")
     return RESTORE_BACKUP_WAIT_FILE
 
 async def handle_restore_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -595,22 +2831,16 @@ async def handle_restore_file(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Нет доступа")
         return ConversationHandler.END
     doc = update.message.document
-    if not doc or not doc.file_name.endswith('.sqlite'):
-        await update.message.reply_text("Пожалуйста, отправьте файл с расширением .sqlite")
+    if not doc or not is_backup_filename(doc.file_name):
+        await update.message.reply_text("Пожалуйста, отправьте файл с расширением .sqlite или .sqlite.gz")
         return RESTORE_BACKUP_WAIT_FILE
     file = await doc.get_file()
-    await file.download_to_drive(DB_FILENAME)
+    await file.download_to_drive(DB_FILENAME + ".restore")
+    await run_blocking(install_backup_file, DB_FILENAME + ".restore", doc.file_name)
     await update.message.reply_text(f"База успешно восстановлена из файла {doc.file_name}!")
     return ConversationHandler.END
 
-if __name__ == '__main__':
-    restore_db_from_telegram()  # сначала восстановить базу
-    migrate_all_bars()
-    start_periodic_backup()     # запустить периодический бэкап
-    threading.Thread(target=run_flask, daemon=True).start()
-    token = os.getenv('BOT_TOKEN')
-    if not token:
-        exit(1)
+def build_bot_app(token):
     bot_app = ApplicationBuilder().token(token).build()
     bot_app.add_handler(ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -628,5 +2858,155 @@ if __name__ == '__main__':
     bot_app.add_handler(CommandHandler('uploadbackup', uploadbackup))
     bot_app.add_handler(CommandHandler('sendbackup', sendbackup))
     bot_app.add_handler(CommandHandler('restorebackup', restorebackup))
+    bot_app.add_handler(CommandHandler('addbar', addbar))
+    bot_app.add_handler(CommandHandler('notifyexpiry', notifyexpiry))
+    bot_app.add_handler(CommandHandler('metrics', metrics))
+    bot_app.add_handler(CommandHandler('stats', stats))
+    bot_app.add_handler(CommandHandler('archive', archive))
     bot_app.add_error_handler(error_handler)
-    bot_app.run_polling()
+    return bot_app
+
+async def start_background_services(bot_app, journal_seq=None):
+    """Сверка с бэкапом в Telegram, планировщик и polling бота.
+
+    Запускаются ровно в одном процессе: в `python app.py` — в нём самом,
+    под gunicorn — в воркере, захватившем LEADER_LOCK_FILE.
+    journal_seq — seq журнала локальной базы на момент запуска (None — сверка не нужна).
+    """
+    bot_runtime.loop, bot_runtime.bot = asyncio.get_running_loop(), bot_app.bot
+    if journal_seq is not None:
+        # get_updates и polling не могут работать одновременно — сверка до запуска бота
+        await restore_db_from_telegram(bot_app.bot, journal_seq)
+    start_periodic_backup()     # запустить периодический бэкап
+    await bot_app.start()
+    await bot_app.updater.start_polling()
+
+async def stop_background_services(bot_app):
+    """Останавливает то, что успел запустить start_background_services (в том числе после сбоя)."""
+    bot_runtime.loop = bot_runtime.bot = None
+    if bot_runtime.scheduler is not None:
+        bot_runtime.scheduler.shutdown(wait=False)
+        bot_runtime.scheduler = None
+    if bot_app.updater.running:
+        await bot_app.updater.stop()
+    if bot_app.running:
+        await bot_app.stop()
+
+async def serve(bot_app):
+    """HTTP API и бот в одном event loop.
+
+    Flask обслуживается через ASGI-адаптер: сами запросы (и работа с базой)
+    выполняются в ограниченном пуле потоков, а uvicorn и бот делят один loop.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(db_executor)
+    port = int(os.environ.get("PORT", 5000))
+    server = uvicorn.Server(uvicorn.Config(
+        WSGIMiddleware(app, workers=HTTP_WORKERS), host="0.0.0.0", port=port, log_level="warning"
+    ))
+    async with bot_app:
+        journal_seq = None
+        if os.path.exists(DB_FILENAME):
+            # локальная база есть — сразу отвечаем на запросы, сверка с Telegram идёт параллельно
+            await loop.run_in_executor(db_executor, migrate_all_bars)
+            journal_seq = await loop.run_in_executor(db_executor, lambda: last_journal_seq(get_db().cursor()))
+        else:
+            await restore_db_from_telegram(bot_app.bot)  # сначала восстановить базу
+            await loop.run_in_executor(db_executor, migrate_all_bars)
+        server_task = asyncio.create_task(server.serve())
+        print(f"[startup] API запущен через {time.monotonic() - PROCESS_STARTED_AT:.2f} с")
+        await start_background_services(bot_app, journal_seq)
+        try:
+            await server_task  # uvicorn сам завершается по SIGINT/SIGTERM
+        finally:
+            await stop_background_services(bot_app)
+
+# --- Несколько воркеров (gunicorn, см. gunicorn.conf.py) ---
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", SQLITE_DB + ".leader.lock")
+LEADER_RETRY_SECONDS = 30
+LEADER_MAX_BACKOFF_SECONDS = 600
+_leader_lock_file = None
+# seq журнала, снятый мастером в prepare_database до того, как воркеры начали
+# писать; None — базу только что восстановили или создали, сверка не нужна
+_startup_journal_seq = None
+
+def prepare_database():
+    """Мастер gunicorn до fork: восстановление (если базы нет) и миграции."""
+    global _startup_journal_seq
+    local_db = os.path.exists(DB_FILENAME)
+    if not local_db and BOT_TOKEN:
+        async def restore():
+            async with Bot(token=BOT_TOKEN) as bot:
+                await restore_db_from_telegram(bot)
+        asyncio.run(restore())
+    migrate_all_bars()
+    if local_db:
+        _startup_journal_seq = last_journal_seq(get_db().cursor())
+    # соединения SQLite и потоки пула не должны переживать fork
+    reset_db_connections()
+
+def reset_after_fork():
+    global db_executor, bot_executor
+    db_executor = ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="db")
+    bot_executor = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix="bot")
+    _write_queue.queue = None  # поток-писатель не переживает fork, стартует заново при первой записи
+    reset_db_connections()
+    invalidate_user_cache()
+    invalidate_schema_cache()
+
+def release_leadership():
+    global _leader_lock_file
+    if _leader_lock_file is not None:
+        _leader_lock_file.close()  # закрытие файла снимает flock
+        _leader_lock_file = None
+
+def try_become_leader():
+    """Неблокирующий flock: лидером становится ровно один процесс, замок снимается при его смерти."""
+    global _leader_lock_file
+    if _leader_lock_file is not None:
+        return True
+    lock_file = open(LEADER_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+    _leader_lock_file = lock_file
+    return True
+
+def run_leader_election(token):
+    """Поток воркера: ждёт лидерства и запускает бота и планировщик.
+
+    Если запуск падает (например, Telegram недоступен при старте), замок
+    отпускается, чтобы лидером мог стать другой воркер, а этот пробует
+    снова с растущей паузой.
+    """
+    async def run():
+        bot_app = build_bot_app(token)
+        async with bot_app:
+            try:
+                await start_background_services(bot_app, _startup_journal_seq)
+                await asyncio.Event().wait()  # до завершения воркера
+            finally:
+                await stop_background_services(bot_app)
+    backoff = LEADER_RETRY_SECONDS
+    while True:
+        while not try_become_leader():
+            time.sleep(LEADER_RETRY_SECONDS)
+        print(f"[leader] Воркер {os.getpid()} запускает бота и планировщик")
+        try:
+            asyncio.run(run())
+        except Exception as e:
+            print(f"[leader] Бот и планировщик остановились с ошибкой: {e}; повтор через {backoff} с")
+        release_leadership()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, LEADER_MAX_BACKOFF_SECONDS)
+
+if __name__ == '__main__':
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        exit(1)
+    try:
+        asyncio.run(serve(build_bot_app(token)))
+    except KeyboardInterrupt:
+        pass  # uvicorn пробрасывает пойманный SIGINT после корректной остановки
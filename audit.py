@@ -0,0 +1,142 @@
+"""Аудит планов запросов: какие SQL приложения читают таблицу целиком.
+
+    python audit.py [your_bot_db.sqlite] [--verbose]
+
+Копирует базу во временный каталог, прогоняет по копии все эндпоинты API
+и фоновые задачи (отправка в Telegram отключена), затем выполняет
+EXPLAIN QUERY PLAN для каждого встреченного шаблона SQL. Полные проходы
+(SCAN по таблице или по всему индексу) печатаются с пометкой; код выхода 1,
+если среди них есть не перечисленные в EXPECTED_SCANS — так регрессию
+видно до деплоя. Исходная база не меняется.
+"""
+import argparse
+import contextlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+AUDIT_USER_ID = "900000001"
+AUDIT_BAR = "АУДИТ01"
+
+# начало шаблона -> почему полный проход здесь нормален
+EXPECTED_SCANS = {
+    "SELECT bar_id, bar_name FROM bars": "реестр баров — десятки строк",
+    "SELECT bar_id FROM bars": "реестр баров — десятки строк",
+    "SELECT tob, name, category, shelf_life_days, opened_shelf_life_days FROM catalog": "справочник целиком грузится в память",
+    "SELECT bar_id, category, SUM(total)": "/stats по всем барам читает все агрегаты",
+    "INSERT INTO inventory_stats": "пересчёт агрегатов при миграции схемы",
+    "INSERT OR IGNORE INTO catalog": "первое наполнение справочника при миграции",
+    "UPDATE inventory SET opened_shelf_life_days": "перенос срока позиций из /open при миграции",
+    "UPDATE inventory_archive SET opened_shelf_life_days": "перенос срока позиций из /open при миграции",
+}
+
+
+def copy_db(path, tmpdir):
+    """Копия базы вместе с WAL: через backup API, а не копированием файла."""
+    target = os.path.join(tmpdir, os.path.basename(path))
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+    return target
+
+
+def run_tour(app_module):
+    """Все эндпоинты и фоновые задачи по одному разу, чтобы поймать их SQL."""
+    app_module.run_bot_call = lambda send: 0  # без Telegram: рассылки и бэкапы не отправляются
+    app_module.ensure_schema()
+    app_module.db_query(
+        f"INSERT OR IGNORE INTO {app_module.BARS_TABLE} (bar_name, created_at) VALUES (?, '2024-01-01 00:00:00')",
+        (AUDIT_BAR,)
+    )
+    app_module.db_query(
+        f"INSERT INTO {app_module.INVITES_TABLE} (code, bar_name, used) VALUES ('AUDIT-CODE', ?, 'нет')", (AUDIT_BAR,)
+    )
+    app_module.register_user(AUDIT_USER_ID, "audit", "AUDIT-CODE")
+    app_module.user_registration(AUDIT_USER_ID)
+    bar_id = app_module.get_bar_id(AUDIT_BAR)
+
+    client = app_module.app.test_client()
+
+    app_module.ADMIN_TOKEN = "audit"
+
+    def post(path, headers=None, **payload):
+        resp = client.post(path, json=dict(user_id=AUDIT_USER_ID, **payload), headers=headers)
+        body = resp.get_json(silent=True)
+        if resp.status_code != 200 or (body is not None and not body.get('ok')):
+            print(f"[audit] {path}: {resp.status_code} {body}", file=sys.stderr)
+        return body or {}
+
+    item = dict(category="☕ Кофе", tob="900001", name="Сироп аудит", manufactured_at="2024-01-01", shelf_life_days=30)
+    first = post('/add', **item)['id']
+    post('/add', **dict(item, tob="900002", opened=1, opened_at="2024-01-05", opened_shelf_life_days=7))
+    post('/open', tob="900003", category="☕ Кофе", name="Молоко аудит", shelf_life_days=3)
+    post('/open', tob="900003", category="☕ Кофе", name="Молоко аудит", shelf_life_days=3)
+    post('/userinfo')
+    post('/catalog', query="9000")
+    for query in ("", "900001", "си", "сироп"):
+        post('/search', query=query, limit=10)
+        post('/search', query=query, limit=10, archived=True)
+    post('/search', query="сироп", rank=True)
+    post('/expired', limit=10)
+    post('/expired', limit=10, archived=True)
+    post('/update', id=first, name="Сироп аудит 2")
+    post('/batch', items=[
+        dict(item, op='add', tob="900004"), {'op': 'update', 'id': first, 'shelf_life_days': 60},
+    ])
+    post('/delete', id=first)
+    post('/stats', days=3)
+    post('/stats', days=3, all=True, headers={'Authorization': 'Bearer audit'})
+
+    day = app_module.msk_today_str()
+    app_module.compute_expiry_digest(bar_id, day)
+    app_module.notify_expiring(force=True)
+    app_module.archive_inventory()
+    app_module.periodic_backup(force=True)
+    app_module.flush_change_journal()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", nargs="?", default=os.getenv("SQLITE_DB", "your_bot_db.sqlite"))
+    parser.add_argument("--verbose", action="store_true", help="печатать планы всех запросов, а не только с полным проходом")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="audit-")
+    try:
+        os.environ["SQLITE_DB"] = copy_db(args.db, tmpdir)
+        # логи приложения — в stderr, в stdout только отчёт
+        with contextlib.redirect_stdout(sys.stderr):
+            import app as app_module
+            app_module.capture_query_samples()
+            run_tour(app_module)
+            report = app_module.explain_query_samples()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    unexpected = 0
+    for template, plan, scans in report:
+        expected = next((reason for prefix, reason in EXPECTED_SCANS.items() if template.startswith(prefix)), None)
+        if scans and not expected:
+            unexpected += 1
+            mark = "ПОЛНЫЙ ПРОХОД"
+        elif scans:
+            mark = f"полный проход, ожидаемо: {expected}"
+        elif args.verbose:
+            mark = "ok"
+        else:
+            continue
+        print(f"[{mark}] {template}")
+        for line in plan:
+            print(f"    {line}")
+    print(f"Шаблонов SQL: {len(report)}, неожиданных полных проходов: {unexpected}")
+    sys.exit(1 if unexpected else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""Микробенчмарк API на временной копии базы.
+
+    python bench.py --requests 2000
+    python bench.py --stress-open 16
+    python bench.py --expiry-rows 100000
+    python bench.py --load 100000 --workers 8 --ops 2000 [--server] [--baseline old.json]
+    python bench.py --payload 20000
+    WRITE_QUEUE=1 python bench.py --load 100000 --workers 16   # с групповым коммитом
+
+Сравнивает старый режим (новое соединение на каждый запрос к базе)
+с пулом соединений из app.py и печатает результат в JSON. --stress-open
+параллельно открывает один и тот же tob и проверяет, что открытая бутылка
+осталась ровно одна (иначе код выхода 1). --expiry-rows сравнивает стоимость строки выдачи:
+текстовые даты со strptime на каждую строку против epoch-day и сроков из SQL.
+
+--load засевает базу синтетическими барами, пользователями и позициями
+(детерминированно по --seed) и по очереди гоняет /add, /open, /search,
+/expired, /update и /delete из --workers потоков — через test client Flask
+или, с --server, через настоящий uvicorn на localhost. Для каждого эндпоинта
+печатаются p50/p95/p99 и пропускная способность; с --baseline — отношение
+к прошлому отчёту (больше 1 — медленнее).
+
+--payload засевает один бар на ROWS позиций и для выдачи /search целиком
+сравнивает прежний ответ (jsonify списка объектов) с форматами objects,
+columns и msgpack, без сжатия, с gzip и brotli (если установлены пакеты):
+размер тела в байтах и медианное время сборки тела в миллисекундах.
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+BENCH_USER_ID = "1"
+BENCH_BAR = "АВОШ59"
+
+
+def seed_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id TEXT, username TEXT, bar_name TEXT, registered_at TEXT)")
+    conn.execute("CREATE TABLE invites (code TEXT, bar_name TEXT, used TEXT, issued_at TEXT)")
+    conn.execute(
+        "INSERT INTO users VALUES (?, ?, ?, ?)",
+        (BENCH_USER_ID, "bench", BENCH_BAR, "2024-01-01 00:00:00")
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_db(app_module):
+    """Эмуляция прежнего поведения: sqlite3.connect на каждый вызов."""
+    def get_db():
+        if not os.path.exists(app_module.SQLITE_DB):
+            raise Exception(f"Файл базы не найден: {app_module.SQLITE_DB}")
+        app_module._db_local.depth = 0
+        return sqlite3.connect(app_module.SQLITE_DB, isolation_level=None)
+    return get_db
+
+
+def run_add(client, n):
+    payload = {
+        "user_id": BENCH_USER_ID, "category": "☕ Кофе", "tob": "123456",
+        "name": "Бенч", "manufactured_at": "2024-01-01", "shelf_life_days": 30,
+    }
+    started = time.perf_counter()
+    for _ in range(n):
+        resp = client.post("/add", json=payload)
+        assert resp.get_json()["ok"], resp.get_json()
+    return n / (time.perf_counter() - started)
+
+
+def stress_open(app_module, workers, rounds):
+    payload = {
+        "user_id": BENCH_USER_ID, "category": "☕ Кофе", "tob": "654321",
+        "name": "Стресс", "shelf_life_days": 10,
+    }
+    failures = []
+
+    def worker():
+        client = app_module.app.test_client()
+        for _ in range(rounds):
+            resp = client.post("/open", json=payload).get_json()
+            if not resp["ok"]:
+                failures.append(resp["error"])
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    total, still_open = app_module.db_query(
+        f"SELECT COUNT(*), SUM(opened=1) FROM {app_module.INVENTORY_TABLE} WHERE bar_id=? AND tob=?",
+        (app_module.get_bar_id(BENCH_BAR), payload["tob"]), fetch=True
+    )[0]
+    return {
+        "open_requests": workers * rounds,
+        "open_rps": round(workers * rounds / elapsed, 1),
+        "failures": len(failures),
+        "rows": total,
+        "open_bottles": still_open,
+        "ok": not failures and total == workers * rounds and still_open == 1,
+    }
+
+
+def legacy_bar_item(r):
+    """Прежний bar_item: текстовые даты и strptime для каждой строки."""
+    def by_days(start, days):
+        if not start or not days:
+            return None
+        try:
+            return (datetime.strptime(start, '%Y-%m-%d') + timedelta(days=int(days))).strftime('%Y-%m-%d')
+        except:
+            return None
+    expiry_by_total = by_days(r[4], r[5])
+    expiry_by_opened = by_days(r[6], r[7])
+    return {
+        'id': r[0], 'category': r[1], 'tob': r[2], 'name': r[3],
+        'manufactured_at': r[4], 'shelf_life_days': r[5],
+        'opened_at': r[6], 'opened_shelf_life_days': r[7],
+        'opened': r[8],
+        'expiry_by_total': expiry_by_total,
+        'expiry_by_opened': expiry_by_opened,
+        'expiry_final': min(expiry_by_total, expiry_by_opened) if expiry_by_total and expiry_by_opened
+        else expiry_by_total or expiry_by_opened
+    }
+
+
+def bench_expiry(app_module, rows):
+    rnd = random.Random(42)
+    bar_id = app_module.get_bar_id(BENCH_BAR)
+    today = app_module.msk_today()
+    items = []
+    for i in range(rows):
+        manufactured = today - rnd.randint(0, 400)
+        opened = rnd.random() < 0.4
+        opened_at = manufactured + rnd.randint(0, 60) if opened else None
+        items.append((
+            bar_id, "☕ Кофе", f"{i % 1000000:06d}", f"Позиция {i}", manufactured, rnd.choice((30, 90, 180, 365)),
+            opened_at, rnd.choice((7, 14, 30)) if opened else None, int(opened)
+        ))
+    with app_module.db_transaction() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {app_module.INVENTORY_TABLE} (bar_id, category, tob, name, manufactured_at, "
+            f"shelf_life_days, opened_at, opened_shelf_life_days, opened) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", items
+        )
+        cursor.execute(f"UPDATE {app_module.INVENTORY_TABLE} SET expiry_final = {app_module.EXPIRY_FINAL_SQL}")
+        # та же выборка в прежнем виде, с текстовыми датами
+        cursor.execute(
+            "CREATE TABLE legacy_inventory (id INTEGER PRIMARY KEY, bar_id INTEGER, category TEXT, tob TEXT, "
+            "name TEXT, manufactured_at TEXT, shelf_life_days INTEGER, opened_at TEXT, "
+            "opened_shelf_life_days INTEGER, opened INTEGER)"
+        )
+        cursor.executemany(
+            "INSERT INTO legacy_inventory (bar_id, category, tob, name, manufactured_at, shelf_life_days, "
+            "opened_at, opened_shelf_life_days, opened) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [r[:4] + (app_module.format_day(r[4]), r[5], app_module.format_day(r[6])) + r[7:] for r in items]
+        )
+    app_module.format_day.cache_clear()
+
+    def per_row_us(sql, make_item):
+        started = time.perf_counter()
+        n = sum(1 for r in app_module.db_query(sql, (bar_id,), fetch=True) if make_item(r))
+        return round((time.perf_counter() - started) / n * 1e6, 3)
+
+    before = per_row_us(
+        "SELECT id, category, tob, name, manufactured_at, shelf_life_days, opened_at, opened_shelf_life_days, "
+        "opened FROM legacy_inventory WHERE bar_id=?", legacy_bar_item
+    )
+    after = per_row_us(
+        f"SELECT {app_module.BAR_SELECT_COLUMNS} FROM {app_module.INVENTORY_TABLE} WHERE bar_id=?", app_module.bar_item
+    )
+    return {"rows": rows, "row_us_before": before, "row_us_after": after}
+
+
+LOAD_NAMES = ("Сироп Ваниль", "Кофе Бразилия", "Молоко овсяное", "Сливки 33%", "Пюре Манго", "Чай Эрл Грей",
+              "Сироп Карамель", "Какао", "Топпинг шоколадный", "Кофе Колумбия")
+LOAD_QUERIES = ("", "сироп", "кофе бра", "мо", "манго", "чай")
+
+
+def bench_payload(app_module, rows, reps=5):
+    user_ids = seed_load(app_module, rows, 1, 1, random.Random(42))
+    bar_id = next(iter(user_ids))
+    db_rows = app_module.db_query(
+        f"SELECT {app_module.BAR_SELECT_COLUMNS} FROM {app_module.INVENTORY_TABLE} WHERE bar_id=? ORDER BY id",
+        (bar_id,), fetch=True
+    )
+
+    def measure(build):
+        timings = []
+        for _ in range(reps):
+            started = time.perf_counter()
+            body = build()
+            timings.append(time.perf_counter() - started)
+        return {"bytes": len(body), "ms": round(sorted(timings)[len(timings) // 2] * 1000, 1)}
+
+    def legacy():
+        with app_module.app.app_context():
+            return app_module.jsonify(
+                ok=True, results=[app_module.bar_item(r) for r in db_rows], next_after=None
+            ).get_data()
+
+    def build(fmt, encoding=None):
+        def run():
+            body = app_module.items_body([app_module.bar_row(r) for r in db_rows], -1, fmt)[0]
+            return app_module.compress_body(body, encoding) if encoding else body
+        return run
+
+    encodings = [None, "gzip"] + (["br"] if app_module.brotli is not None else [])
+    formats = ["objects", "columns"] + (["msgpack"] if app_module.msgpack is not None else [])
+    report = {
+        "rows": len(db_rows),
+        "json_encoder": "orjson" if app_module.orjson is not None else "json",
+        "legacy_jsonify": measure(legacy),
+    }
+    if app_module.orjson is not None:
+        # тот же формат objects на стандартном json — вклад orjson отдельно от формата
+        fast, app_module.orjson = app_module.orjson, None
+        report["objects_stdlib_json"] = measure(build("objects"))
+        app_module.orjson = fast
+    for fmt in formats:
+        for encoding in encodings:
+            report[f"{fmt}_{encoding or 'identity'}"] = measure(build(fmt, encoding))
+    return report
+
+
+def seed_load(app_module, rows, bars, users_per_bar, rnd):
+    """Синтетические бары, пользователи и позиции; возвращает user_id по барам."""
+    app_module.ensure_schema()
+    today = app_module.msk_today()
+    user_ids = {}
+    with app_module.db_transaction(immediate=True) as cursor:
+        # журнал при засеве не нужен: миллион строк в change_log только замедлит засев
+        for suffix in ('ai', 'au', 'ad'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS journal_{app_module.INVENTORY_TABLE}_{suffix}")
+        bar_ids = []
+        for b in range(bars):
+            bar_name = f"НАГР{b:03d}"
+            cursor.execute(f"INSERT OR IGNORE INTO {app_module.BARS_TABLE} (bar_name) VALUES (?)", (bar_name,))
+            bar_id = cursor.execute(
+                f"SELECT bar_id FROM {app_module.BARS_TABLE} WHERE bar_name=?", (bar_name,)
+            ).fetchone()[0]
+            bar_ids.append(bar_id)
+            user_ids[bar_id] = []
+            for u in range(users_per_bar):
+                user_id = str(1_000_000 + b * users_per_bar + u)
+                cursor.execute(
+                    f"INSERT INTO {app_module.USERS_TABLE} (user_id, username, bar_name, registered_at) VALUES (?, ?, ?, ?)",
+                    (user_id, f"load{user_id}", bar_name, "2024-01-01 00:00:00")
+                )
+                user_ids[bar_id].append(user_id)
+        chunk = []
+        for i in range(rows):
+            manufactured = today - rnd.randint(0, 400)
+            opened = rnd.random() < 0.3
+            chunk.append((
+                bar_ids[i % bars], "☕ Кофе", f"{rnd.randint(0, 999999):06d}", f"{rnd.choice(LOAD_NAMES)} {i}",
+                manufactured, rnd.choice((30, 90, 180, 365)),
+                manufactured + rnd.randint(0, 60) if opened else None, rnd.choice((7, 14, 30)) if opened else None,
+                int(opened)
+            ))
+            if len(chunk) == 10000 or i == rows - 1:
+                cursor.executemany(
+                    f"INSERT INTO {app_module.INVENTORY_TABLE} (bar_id, category, tob, name, manufactured_at, "
+                    f"shelf_life_days, opened_at, opened_shelf_life_days, opened) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", chunk
+                )
+                chunk = []
+        cursor.execute(f"UPDATE {app_module.INVENTORY_TABLE} SET expiry_final = {app_module.EXPIRY_FINAL_SQL}")
+        app_module.ensure_change_journal(cursor)
+    return user_ids
+
+
+class TestClientTransport:
+    def __init__(self, app_module):
+        self.client = app_module.app.test_client()
+
+    def post(self, path, payload):
+        resp = self.client.post(path, json=payload)
+        return resp.status_code, resp.get_json()
+
+
+class HttpTransport:
+    """Одно keep-alive соединение на поток, как у браузера."""
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def post(self, path, payload):
+        self.conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        resp = self.conn.getresponse()
+        return resp.status, json.loads(resp.read())
+
+
+def start_server(app_module):
+    """uvicorn с тем же ASGI-адаптером, что и в app.serve, в фоновом потоке."""
+    import socket
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        WSGIMiddleware(app_module.app, workers=app_module.HTTP_WORKERS), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return port
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_phase(make_transport, workers, ops, make_request):
+    """ops запросов из workers потоков; make_request(rnd, i) -> (path, payload)."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index):
+        transport = make_transport()
+        rnd = random.Random(index)
+        local = []
+        for i in range(index, ops, workers):
+            path, payload = make_request(rnd, i)
+            started = time.perf_counter()
+            status, body = transport.post(path, payload)
+            local.append(time.perf_counter() - started)
+            if status != 200 or not body.get("ok"):
+                with lock:
+                    errors.append(body.get("error") if isinstance(body, dict) else status)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_load(app_module, args):
+    rnd = random.Random(args.seed)
+    started = time.perf_counter()
+    user_ids = seed_load(app_module, args.load, args.bars, args.users_per_bar, rnd)
+    seed_seconds = round(time.perf_counter() - started, 2)
+    if args.server:
+        port = start_server(app_module)
+        make_transport = lambda: HttpTransport(port)
+    else:
+        make_transport = lambda: TestClientTransport(app_module)
+    bar_ids = sorted(user_ids)
+    added = []  # id позиций из фазы /add — их обновляем и удаляем
+    added_lock = threading.Lock()
+
+    def user(rnd_):
+        return rnd_.choice(user_ids[rnd_.choice(bar_ids)])
+
+    def add(rnd_, i):
+        return "/add", {
+            "user_id": user(rnd_), "category": "☕ Кофе", "tob": f"{rnd_.randint(0, 999999):06d}",
+            "name": f"{rnd_.choice(LOAD_NAMES)} нагрузка", "manufactured_at": "2026-01-01", "shelf_life_days": 90,
+        }
+
+    def open_(rnd_, i):
+        return "/open", {
+            "user_id": user(rnd_), "category": "☕ Кофе", "tob": f"{rnd_.randint(0, 99):06d}",
+            "name": "Открытая", "shelf_life_days": 14,
+        }
+
+    def search(rnd_, i):
+        return "/search", {"user_id": user(rnd_), "query": rnd_.choice(LOAD_QUERIES), "limit": args.page}
+
+    def expired(rnd_, i):
+        return "/expired", {"user_id": user(rnd_), "limit": args.page}
+
+    def update(rnd_, i):
+        item_id, user_id = added[i % len(added)]
+        return "/update", {"user_id": user_id, "id": item_id, "shelf_life_days": rnd_.choice((30, 60, 90))}
+
+    def delete(rnd_, i):
+        item_id, user_id = added[i % len(added)]
+        return "/delete", {"user_id": user_id, "id": item_id}
+
+    # id добавленных позиций нужны для /update и /delete: /add гоняем со сбором ответов
+    class RecordingTransport:
+        def __init__(self):
+            self.inner = make_transport()
+
+        def post(self, path, payload):
+            status, body = self.inner.post(path, payload)
+            if body.get("ok"):
+                with added_lock:
+                    added.append((body["id"], payload["user_id"]))
+            return status, body
+
+    report = {
+        "config": {
+            "rows": args.load, "bars": args.bars, "users_per_bar": args.users_per_bar, "workers": args.workers,
+            "ops": args.ops, "page": args.page, "seed": args.seed, "transport": "http" if args.server else "test_client",
+            "write_queue": app_module.WRITE_QUEUE_ENABLED,
+        },
+        "seed_seconds": seed_seconds,
+        "endpoints": {},
+    }
+    phases = (("/add", add, RecordingTransport), ("/open", open_, None), ("/search", search, None),
+              ("/expired", expired, None), ("/update", update, None), ("/delete", delete, None))
+    for path, make_request, transport in phases:
+        # /update и /delete работают по позициям, добавленным в фазе /add
+        ops = args.ops if path not in ("/update", "/delete") else min(args.ops, len(added))
+        report["endpoints"][path] = run_phase(transport or make_transport, args.workers, ops, make_request)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("endpoints", {})
+        report["vs_baseline"] = {
+            path: {
+                "p95_ratio": round(stats["p95_ms"] / baseline[path]["p95_ms"], 2),
+                "rps_ratio": round(baseline[path]["rps"] / stats["rps"], 2),
+            }
+            for path, stats in report["endpoints"].items() if path in baseline
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--stress-open", type=int, default=0, metavar="WORKERS")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--expiry-rows", type=int, default=0, metavar="ROWS")
+    parser.add_argument("--load", type=int, default=0, metavar="ROWS", help="нагрузочный прогон на ROWS позициях")
+    parser.add_argument("--bars", type=int, default=10)
+    parser.add_argument("--users-per-bar", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=1000, help="запросов на эндпоинт")
+    parser.add_argument("--page", type=int, default=100, help="limit для /search и /expired")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server", action="store_true", help="через uvicorn на localhost вместо test client")
+    parser.add_argument("--baseline", metavar="JSON", help="прошлый отчёт --load для сравнения")
+    parser.add_argument("--payload", type=int, default=0, metavar="ROWS", help="размер и сборка выдачи бара на ROWS позициях")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="barbench-")
+    os.environ["SQLITE_DB"] = os.path.join(tmpdir, "bench.sqlite")
+    seed_db(os.environ["SQLITE_DB"])
+
+    # логи приложения — в stderr, чтобы stdout оставался чистым JSON (например, для --baseline)
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as app_module
+        if args.load:
+            report = run_load(app_module, args)
+        elif args.payload:
+            report = bench_payload(app_module, args.payload)
+        else:
+            report = run_micro(app_module, args)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report.get("stress_open", {}).get("ok", True):
+        sys.exit(1)
+
+
+def run_micro(app_module, args):
+    client = app_module.app.test_client()
+    pooled_get_db = app_module.get_db
+
+    report = {"requests": args.requests}
+    app_module.get_db = legacy_get_db(app_module)
+    report["add_rps_before"] = round(run_add(client, args.requests), 1)
+    app_module.get_db = pooled_get_db
+    report["add_rps_after"] = round(run_add(client, args.requests), 1)
+    if args.stress_open:
+        report["stress_open"] = stress_open(app_module, args.stress_open, args.rounds)
+    if args.expiry_rows:
+        report["expiry"] = bench_expiry(app_module, args.expiry_rows)
+    return report
+
+
+if __name__ == "__main__":
+    main()
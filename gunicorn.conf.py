@@ -0,0 +1,29 @@
+"""Продакшен-запуск: gunicorn -c gunicorn.conf.py app:app
+
+Мастер один раз готовит базу (восстановление из Telegram и миграции) до
+fork. Каждый воркер обслуживает HTTP, а бота, периодический бэкап и сброс
+журнала запускает только воркер, захвативший LEADER_LOCK_FILE; если он
+падает, замок освобождается и лидером становится другой воркер.
+"""
+import os
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("HTTP_WORKERS", 16))
+timeout = 120
+preload_app = True
+
+
+def on_starting(server):
+    import app
+    app.prepare_database()
+
+
+def post_fork(server, worker):
+    import app
+    app.reset_after_fork()
+    token = os.getenv("BOT_TOKEN")
+    if token:
+        threading.Thread(target=app.run_leader_election, args=(token,), daemon=True, name="leader").start()
@@ -0,0 +1,24 @@
+"""Восстановление базы из полного снимка и дельт журнала изменений.
+
+    python replay.py your_bot_db.sqlite.gz journal-*.ndjson.gz -o restored.sqlite
+
+Снимок — файл от /sendbackup или периодического бэкапа, дельты — файлы
+journal-<от>-<до>.ndjson.gz, которые бот присылает каждые JOURNAL_FLUSH_SECONDS.
+"""
+import argparse
+
+from app import replay_change_journal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", help="полный снимок (.sqlite или .sqlite.gz)")
+    parser.add_argument("deltas", nargs="*", help="дельты журнала (.ndjson.gz)")
+    parser.add_argument("-o", "--output", required=True, help="куда записать восстановленную базу")
+    args = parser.parse_args()
+    applied = replay_change_journal(args.base, args.deltas, args.output)
+    print(f"Применено изменений: {applied}. База записана в {args.output}")
+
+
+if __name__ == "__main__":
+    main()